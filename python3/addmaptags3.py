@@ -1,6 +1,8 @@
 import ast
+import functools
 import json
 import logging
+import multiprocessing
 import os
 import pprint
 import subprocess
@@ -10,67 +12,66 @@ import time
 import piexif
 from tqdm import tqdm
 
-from exifpil3 import PILExifReader
+from atomicwrite3 import get_writer, init_worker, worker_args
+from exifpil3 import PILExifReader, get_exiftool_pool
+from exifwriter3 import read_exif_bytes, write_exif_bytes
+from scanner3 import scan_folder
+from workerlog3 import replay, worker_log
 
 import PIL
 
-def add_mapillary_tags(filepath, log):
-    exif_reader = PILExifReader(filepath)
-    log.debug("exif log:" + exif_reader.get_exif_log())
+wanted_description_tags = {
+    "MAPCompassHeading":
+    {
+        "TrueHeading": 0,
+        "MagneticHeading": 0,
+        "AccuracyDegrees": 0
+    },
+    "MAPGpsTime": "",
+    "MAPVersionString": "",
+    "MAPLatitude": 0,
+    "MAPCaptureTime": "",
+    "MAPGPSSpeed": 0,
+    "MAPDeviceModel": "",
+    "MAPAppNameString": "",
+    "MAPAltitude": 0,
+    "MAPLocalTimeZone": "",
+    "MAPGPSAccuracyMeters": 0,
+    "MAPAtanAngle": 0,
+    "MAPLongitude": 0,
+    "MAPDeviceMake": "",
+    "MAPAccelerometerVector":
+    {
+        "x": 0,
+        "y": 0,
+        "z": 0
+    }
+}
 
-    exif_image_description = exif_reader.get_exif_tag("ImageDescription")
-    try:
-        exif_image_description = ast.literal_eval(exif_image_description)
-    except:
-        pass
+# tags read by the batch mode, one recursive exiftool call per folder
+batch_metadata_tags = ["-EXIF:ImageDescription", "-Description", "-DateTimeOriginal",
+                       "-Composite:GPSLatitude", "-Composite:GPSLongitude",
+                       "-GPSImgDirection", "-GPSTrack"]
 
-    log.debug("exif_image_description: " +
-              pprint.pformat(exif_image_description))
 
-    xmp_description = ast.literal_eval(
-        exif_reader.get_XMP_description() or "{}")
-    log.debug("xmp_description: " + pprint.pformat(xmp_description))
+def parse_image_description(description):
+    try:
+        return ast.literal_eval(description)
+    except:
+        return description
 
-    # exif_reader.remove_XMP_description()
-
-    wanted_description_tags = {
-        "MAPCompassHeading":
-        {
-            "TrueHeading": 0,
-            "MagneticHeading": 0,
-            "AccuracyDegrees": 0
-        },
-        "MAPGpsTime": "",
-        "MAPVersionString": "",
-        "MAPLatitude": 0,
-        "MAPCaptureTime": "",
-        "MAPGPSSpeed": 0,
-        "MAPDeviceModel": "",
-        "MAPAppNameString": "",
-        "MAPAltitude": 0,
-        "MAPLocalTimeZone": "",
-        "MAPGPSAccuracyMeters": 0,
-        "MAPAtanAngle": 0,
-        "MAPLongitude": 0,
-        "MAPDeviceMake": "",
-        "MAPAccelerometerVector":
-        {
-            "x": 0,
-            "y": 0,
-            "z": 0
-        }
-    }
 
+def build_mapillary_payload(exif_image_description, capture_time, lat_lon, heading):
+    """builds the MAPxxx payload dict from the already extracted image metadata"""
     # setup payload_dict with initial data from exif:
     payload_dict = {}
-    datetime = exif_reader.read_capture_time()
-    if datetime != None:
-        str_timestamp = datetime.strftime("%Y_%m_%d_%H_%M_%S_%f")[:-3]
+    if capture_time != None:
+        str_timestamp = capture_time.strftime("%Y_%m_%d_%H_%M_%S_%f")[:-3]
         payload_dict["MAPCaptureTime"] = str_timestamp
 
     # set latitude and longitude
     try:
-        lat, lon = exif_reader.get_lat_lon()
+        lat, lon = lat_lon
         if lat != None and lon != None:
             payload_dict["MAPLongitude"] = lon
             payload_dict["MAPLatitude"] = lat
@@ -78,7 +79,6 @@ def add_mapillary_tags(filepath, log):
         pass
 
     # set heading
-    heading = exif_reader.get_rotation()
     if heading is not None:
         payload_dict["MAPCompassHeading"] = {}
         payload_dict["MAPCompassHeading"]["TrueHeading"] = float(heading)
@@ -93,26 +93,126 @@ def add_mapillary_tags(filepath, log):
                             payload_dict[key][key2] = exif_image_description[key][key2]
                 else:
                     payload_dict[key] = exif_image_description[key]
+    return payload_dict
+
 
+def write_mapillary_payload(filepath, payload_dict, log, exif_bytes=None):
+    """writes the payload as ImageDescription, only the EXIF segment of the file is rewritten
+       exif_bytes are the current EXIF bytes of the file if already read, e.g. by PILExifReader
+    """
+    if exif_bytes is None:
+        exif_bytes = read_exif_bytes(get_writer().current(filepath))
+    in_place = write_exif_bytes(filepath, mapillary_exif_bytes(exif_bytes, payload_dict, log))
+    log.debug("exif written " + ("in place" if in_place else "by copy") +
+              ": " + filepath)
+    return True
+
+
+def mapillary_exif_bytes(exif_bytes, payload_dict, log):
+    """returns exif_bytes, or empty EXIF if None, with the payload as ImageDescription"""
     payload_json = json.dumps(payload_dict)
     # log.info(payload_json)
-    exif_dict = piexif.load(filepath)
+    if exif_bytes:
+        exif_dict = piexif.load(exif_bytes)
+    else:
+        exif_dict = {"0th": {}, "Exif": {}, "GPS": {},
+                     "Interop": {}, "1st": {}, "thumbnail": None}
     log.debug(pprint.pformat(exif_dict))
     exif_dict['0th'][piexif.ImageIFD.ImageDescription] = payload_json.encode(
         'utf-8')
-    exif_bytes = piexif.dump(exif_dict)
-    piexif.insert(exif_bytes, filepath)
-    # pprint.pprint(exif_dict)
-    return True
+    return piexif.dump(exif_dict)
+
 
+def add_mapillary_tags(filepath, log):
+    exif_reader = PILExifReader(get_writer().current(filepath))
+    payload_dict = read_mapillary_payload(exif_reader, log)
+    return write_mapillary_payload(filepath, payload_dict, log,
+                                   exif_reader.get_exif_bytes())
 
-def image_files(files):
-    return [f for f in files if f.lower().endswith('.jpg')
-            or f.lower().endswith('.jpeg')]
 
+def read_mapillary_payload(exif_reader, log):
+    """builds the payload dict from the tags read by a PILExifReader"""
+    log.debug("exif log:" + exif_reader.get_exif_log())
+
+    exif_image_description = parse_image_description(
+        exif_reader.get_exif_tag("ImageDescription"))
+    log.debug("exif_image_description: " +
+              pprint.pformat(exif_image_description))
 
-def process_image_tags(folder_path, dry_run, log) -> bool:
+    xmp_description = ast.literal_eval(
+        exif_reader.get_XMP_description() or "{}")
+    log.debug("xmp_description: " + pprint.pformat(xmp_description))
+
+    # exif_reader.remove_XMP_description()
+
+    return build_mapillary_payload(exif_image_description,
+                                   exif_reader.read_capture_time(),
+                                   exif_reader.get_lat_lon(),
+                                   exif_reader.get_rotation())
+
+
+def read_folder_metadata(folder_path):
+    """reads the EXIF and XMP tags of all JPEGs below folder_path with one
+       recursive exiftool -json call, returns a dict keyed by normalized path
+    """
+    output = get_exiftool_pool().execute(
+        "-json", "-n", "-r", "-ext", "jpg", "-ext", "jpeg",
+        *batch_metadata_tags, folder_path)
+    metadata = {}
+    for entry in json.loads(output or "[]"):
+        metadata[os.path.normpath(entry["SourceFile"])] = entry
+    return metadata
+
+
+def add_mapillary_tags_from_metadata(filepath, metadata, log):
+    """like add_mapillary_tags, but takes the tags from a read_folder_metadata entry"""
+    log.debug("exif metadata: " + pprint.pformat(metadata))
+
+    exif_image_description = parse_image_description(
+        str(metadata.get("ImageDescription", "")))
+    log.debug("exif_image_description: " +
+              pprint.pformat(exif_image_description))
+    log.debug("xmp_description: " +
+              pprint.pformat(metadata.get("Description", {})))
+
+    capture_time = metadata.get("DateTimeOriginal")
+    if capture_time:
+        capture_time = PILExifReader.parse_capture_time(str(capture_time))
+    else:
+        capture_time = None
+    lat_lon = (metadata.get("GPSLatitude"), metadata.get("GPSLongitude"))
+    heading = metadata.get("GPSImgDirection", metadata.get("GPSTrack"))
+
+    payload_dict = build_mapillary_payload(exif_image_description,
+                                           capture_time, lat_lon, heading)
+    return write_mapillary_payload(filepath, payload_dict, log)
+
+
+def tag_chunk(chunk, log_level=logging.INFO):
+    """process pool worker, tags a chunk of (file path, metadata or None) pairs of one directory
+       returns the directory, the number of files, the failed files with their error and the log records
+    """
+    log, records = worker_log(__name__, log_level)
+    failures = []
+    for file_path, metadata in chunk:
+        try:
+            if metadata is not None:
+                add_mapillary_tags_from_metadata(file_path, metadata, log)
+            else:
+                add_mapillary_tags(file_path, log)
+        except Exception as error:
+            failures.append((file_path, repr(error)))
+    # one batch of directory fsyncs per chunk
+    get_writer().sync()
+    return os.path.dirname(chunk[0][0]), len(chunk), failures, records
+
+
+def process_image_tags(folder_path, dry_run, log, batch=False, jobs=1, chunk_size=16, manifest=None) -> bool:
     """processes image tags like exif, XMP and adds the necessary and optional tags for mapillary if possible
+       manifest is the scanner3.Manifest of folder_path, it is scanned if not given
+       with batch set, the tags of the whole folder are read with one exiftool call up front
+       with jobs > 1, chunks of chunk_size files are tagged in a pool of that many processes
+       failing files are logged and the remaining ones are still tagged
        returns success
     """
     if dry_run:
@@ -123,14 +223,10 @@ def process_image_tags(folder_path, dry_run, log) -> bool:
         log.warning("No valid directory given as parameter.")
         return False
 
-    # compute totals for progress bar
-    total_images = 0
-    total_image_dirs = 0
-    for path, _, files in os.walk(folder_path):
-        new_images = len(image_files(files))
-        total_images += new_images
-        if new_images > 0:
-            total_image_dirs += 1
+    if manifest is None:
+        manifest = scan_folder(folder_path)
+    total_images = manifest.total_images
+    total_image_dirs = manifest.total_image_dirs
 
     # initialize progress bars
     total_pbar = tqdm(total=total_images, dynamic_ncols=True)
@@ -139,19 +235,45 @@ def process_image_tags(folder_path, dry_run, log) -> bool:
     else:
         dirs_pbar = None
 
+    folder_metadata = {}
+    if batch and not dry_run:
+        log.info("   *** Reading tags of all images: " + folder_path)
+        folder_metadata = read_folder_metadata(folder_path)
+
+    if jobs > 1 and not dry_run:
+        process_image_tags_parallel(
+            manifest, folder_metadata, jobs, chunk_size, total_pbar, dirs_pbar, log)
+        total_pbar.close()
+        if dirs_pbar:
+            dirs_pbar.close()
+        return True
+
     # Loop over JPG files
-    for path, _, files in os.walk(folder_path):
-        if len(files) > 0:
+    failed = 0
+    for path, entries in manifest.image_dirs():
+        if len(entries) > 0:
             log.info("   *** Adding ImageDescription: " + path)
-            for file_name in image_files(files):
-                absolute_file_path = path + os.sep + file_name
-                if not dry_run:
-                    add_mapillary_tags(absolute_file_path, log)
-                else:
-                    time.sleep(1/total_images)
+            for entry in entries:
+                absolute_file_path = entry.path
+                metadata = folder_metadata.get(
+                    os.path.normpath(absolute_file_path))
+                try:
+                    if not dry_run and metadata is not None:
+                        add_mapillary_tags_from_metadata(
+                            absolute_file_path, metadata, log)
+                    elif not dry_run:
+                        add_mapillary_tags(absolute_file_path, log)
+                    else:
+                        time.sleep(1/total_images)
+                except Exception as error:
+                    log.error("tagging failed: " + absolute_file_path + ": " + repr(error))
+                    failed += 1
                 total_pbar.update()
             if dirs_pbar:
                 dirs_pbar.update()
+    get_writer().sync()
+    if failed > 0:
+        log.error("   *** Tagging failed for " + str(failed) + " images")
     total_pbar.close()
     if dirs_pbar:
         dirs_pbar.close()
@@ -159,6 +281,36 @@ def process_image_tags(folder_path, dry_run, log) -> bool:
     return True
 
 
+def process_image_tags_parallel(manifest, folder_metadata, jobs, chunk_size, total_pbar, dirs_pbar, log):
+    # split every directory into chunks, a chunk never spans two directories
+    chunks = []
+    remaining_per_dir = {}
+    for path, entries in manifest.image_dirs():
+        remaining_per_dir[path] = len(entries)
+        for start in range(0, len(entries), chunk_size):
+            chunks.append([(entry.path, folder_metadata.get(os.path.normpath(entry.path)))
+                           for entry in entries[start:start + chunk_size]])
+
+    log.info("   *** Adding ImageDescription with " + str(jobs) + " processes")
+    worker = functools.partial(tag_chunk, log_level=log.getEffectiveLevel())
+    failed = 0
+    with multiprocessing.Pool(jobs, initializer=init_worker,
+                              initargs=worker_args()) as pool:
+        for path, count, failures, records in pool.imap_unordered(worker, chunks):
+            replay(log, records)
+            for file_path, error in failures:
+                log.error("tagging failed: " + file_path + ": " + error)
+            failed += len(failures)
+            total_pbar.update(count)
+            remaining_per_dir[path] -= count
+            if remaining_per_dir[path] == 0:
+                log.info("   *** Added ImageDescription: " + path)
+                if dirs_pbar:
+                    dirs_pbar.update()
+    if failed > 0:
+        log.error("   *** Tagging failed for " + str(failed) + " images")
+
+
 #
 #   Main
 #
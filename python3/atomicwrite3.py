@@ -0,0 +1,150 @@
+#
+#   file: atomicwrite3.py
+#
+#   purpose: the one write path of the stages that rewrite images. A file is
+#            written to a temp file in its target directory, fsynced and
+#            renamed over the target, so a killed run leaves the old or the
+#            new image, never a truncated one. The directories are fsynced in
+#            batches instead of after every rename. The writes can also go to
+#            a separate output tree, leaving the source folder untouched.
+#            Process pools hand the writer to their workers with
+#            init_worker(), forked, spawned or from a forkserver alike.
+#
+
+import contextlib
+import os
+import tempfile
+import threading
+
+
+class AtomicWriter:
+    """Writes files atomically. The renames are made durable by fsyncing their
+    directories every dir_sync_batch files and on sync(); a crash in between
+    may undo the last renames, which leaves the older, intact files.
+    With output_root, a file below source_root is written to the same relative
+    path below output_root instead, and read from there once it exists."""
+
+    def __init__(self, output_root=None, source_root=None, dir_sync_batch=32):
+        self.output_root = os.path.abspath(output_root) if output_root else None
+        self.source_root = os.path.abspath(source_root or os.curdir)
+        self._dir_sync_batch = dir_sync_batch
+        self._dirty_dirs = set()
+        self._renames = 0
+        self._lock = threading.Lock()
+
+    def destination(self, path):
+        """where path, a file or directory of the source tree, is written to"""
+        if self.output_root is None:
+            return path
+        relative_path = os.path.relpath(os.path.abspath(path), self.source_root)
+        if relative_path == os.curdir:
+            return self.output_root
+        return os.path.join(self.output_root, relative_path)
+
+    def current(self, file_path):
+        """the latest version of file_path, its written copy if there is one"""
+        destination = self.destination(file_path)
+        if destination != file_path and os.path.exists(destination):
+            return destination
+        return file_path
+
+    @contextlib.contextmanager
+    def replace(self, file_path):
+        """yields a binary file that replaces the destination of file_path when the block
+           ends without an exception, else the destination stays as it was
+        """
+        destination = self.destination(file_path)
+        directory = os.path.dirname(os.path.abspath(destination))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            mode_source = self.current(file_path)
+            if os.path.exists(mode_source):
+                os.chmod(temp_path, os.stat(mode_source).st_mode & 0o7777)
+            os.replace(temp_path, destination)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with self._lock:
+            self._dirty_dirs.add(directory)
+            self._renames += 1
+            if self._renames < self._dir_sync_batch:
+                return
+        self.sync()
+
+    def sync(self):
+        """fsyncs the directories of all renames so far, where the system can"""
+        with self._lock:
+            dirs = self._dirty_dirs
+            self._dirty_dirs = set()
+            self._renames = 0
+        if os.name == "nt":
+            # Windows can not open a directory, NTFS journals the renames itself
+            return
+        for directory in dirs:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+            except OSError:
+                # e.g. a network share, the renames are still made, just not fsynced
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """the AtomicWriter of all stages, writing in place unless set_writer() set another"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = AtomicWriter()
+        return _writer
+
+
+def set_writer(writer):
+    """sets the AtomicWriter of all stages, before any pool processes are started"""
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.sync()
+        _writer = writer
+
+
+def worker_args():
+    """initargs of init_worker() for the AtomicWriter of all stages"""
+    writer = get_writer()
+    return writer.output_root, writer.source_root, writer._dir_sync_batch
+
+
+def init_worker(output_root, source_root, dir_sync_batch):
+    """process pool initializer, sets up the AtomicWriter of the parent in a worker, which
+       only inherits it when forked, e.g. not on Windows
+       multiprocessing.Pool(jobs, initializer=init_worker, initargs=worker_args())
+    """
+    set_writer(AtomicWriter(output_root, source_root, dir_sync_batch))
+
+
+def _forget_pending_dirs():
+    # the parent syncs what it renamed itself, a forked child only its own renames
+    global _writer_lock
+    _writer_lock = threading.Lock()
+    if _writer is not None:
+        _writer._lock = threading.Lock()
+        _writer._dirty_dirs = set()
+        _writer._renames = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_pending_dirs)
@@ -0,0 +1,469 @@
+#
+#   file: benchmark3.py
+#
+#   purpose: measure the throughput of the processing stages on synthetic
+#            JPEGs with GPS tags, so changes can be compared without a
+#            real capture at hand, e.g.
+#
+#            python3 benchmark3.py tagging --images 400 --jobs 1 2 4 8
+#            python3 benchmark3.py upload --concurrency 1 4 16 --latency 0.1
+#            python3 benchmark3.py --dirs 20 upload --session_latency 0.5 --prefetch 0 2
+#            python3 benchmark3.py --size 4000 3000 --images 32 upload_memory
+#            python3 benchmark3.py --size 4000 3000 --images 4 blur
+#            python3 benchmark3.py --images 0 blur_scale --sample ~/capture --widths 2000 1000 500
+#            python3 benchmark3.py --images 0 dupes --frames 100000 --passes 2
+#            python3 benchmark3.py --images 0 gps --points 1000000
+#
+#            gps compares with the per point functions of sequencesplit3,
+#            which needs exifread, without it only the haversine is compared.
+#
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import piexif
+from PIL import Image
+
+
+def make_sample_images(folder_path, count, width=640, height=480, dirs=1):
+    """writes count JPEGs with capture time, position and heading into dirs sub directories"""
+    for i in range(count):
+        dir_path = folder_path + os.sep + "%04d" % (i % dirs)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        lat = 52.5 + i * 0.00005
+        exif_dict = {
+            "0th": {piexif.ImageIFD.Make: b"Garmin", piexif.ImageIFD.Model: b"VIRB 360"},
+            "Exif": {piexif.ExifIFD.DateTimeOriginal:
+                     time.strftime("%Y:%m:%d %H:%M:%S", time.gmtime(1558084449 + i)).encode("utf-8")},
+            "GPS": {
+                piexif.GPSIFD.GPSLatitudeRef: b"N",
+                piexif.GPSIFD.GPSLatitude: ((int(lat), 1), (int(lat * 60) % 60, 1),
+                                            (int(lat * 3600000) % 60000, 1000)),
+                piexif.GPSIFD.GPSLongitudeRef: b"E",
+                piexif.GPSIFD.GPSLongitude: ((13, 1), (24, 1), (0, 1)),
+                piexif.GPSIFD.GPSImgDirection: (i % 360, 1),
+            },
+        }
+        image = Image.effect_noise((width, height), 64).convert("RGB")
+        image.save(dir_path + os.sep + "%06d.jpg" % i, quality=95,
+                   exif=piexif.dump(exif_dict))
+
+
+def report(name, count, seconds):
+    print("%-24s %8d images %8.2f s %10.1f images/s" %
+          (name, count, seconds, count / seconds if seconds > 0 else 0))
+
+
+def bench_tagging(args, log):
+    from addmaptags3 import process_image_tags
+    for jobs in args.jobs:
+        start = time.perf_counter()
+        process_image_tags(args.folder, False, log,
+                           batch=args.batch, jobs=jobs)
+        report("tagging jobs=%d" % jobs, args.images,
+               time.perf_counter() - start)
+
+
+def bench_optimize(args, log):
+    from jpegoptimizer3 import optimize_folder
+    for jobs in args.jobs:
+        # a fresh copy every time, optimized images would encode faster
+        folder_path = tempfile.mkdtemp(prefix="mapillary_benchmark_") + os.sep + "images"
+        shutil.copytree(args.folder, folder_path)
+        start = time.perf_counter()
+        totals = optimize_folder(folder_path, False, log, jobs=jobs, max_width=args.max_width,
+                                 target_bytes=int(args.target_kb * 1024) if args.target_kb else None,
+                                 target_bpp=args.target_bpp)
+        seconds = time.perf_counter() - start
+        report("optimize jobs=%d" % jobs, args.images, seconds)
+        print("    %.1f MB/s, %.1f MB -> %.1f MB" % (
+            totals["bytes before"] / 1024 / 1024 / seconds,
+            totals["bytes before"] / 1024 / 1024, totals["bytes after"] / 1024 / 1024))
+        start = time.perf_counter()
+        optimize_folder(folder_path, False, log, jobs=jobs, max_width=args.max_width)
+        report("  rerun jobs=%d" % jobs, args.images, time.perf_counter() - start)
+        shutil.rmtree(os.path.dirname(folder_path))
+
+
+def bench_tag_optimize(args, log):
+    from addmaptags3 import process_image_tags
+    from jpegoptimizer3 import optimize_folder
+    for fused in (False, True):
+        folder_path = tempfile.mkdtemp(prefix="mapillary_benchmark_") + os.sep + "images"
+        shutil.copytree(args.folder, folder_path)
+        start = time.perf_counter()
+        if not fused:
+            process_image_tags(folder_path, False, log)
+        optimize_folder(folder_path, False, log, tag=fused)
+        report("tag+optimize fused=%s" % fused, args.images, time.perf_counter() - start)
+        shutil.rmtree(os.path.dirname(folder_path))
+
+
+def blur_extent_loops(x):
+    """blurdetect3.blur_extent as the block loops it replaced, for reference"""
+    import numpy
+    from blurdetect3 import haar_dwt2, thresh
+    x = x[0:(numpy.shape(x)[0] // 16) * 16, 0:(numpy.shape(x)[1] // 16) * 16]
+    LL1, Emap1 = haar_dwt2(x)
+    LL2, Emap2 = haar_dwt2(LL1)
+    LL3, Emap3 = haar_dwt2(LL2)
+    Emax = []
+    for Emap, size in ((Emap1, 8), (Emap2, 4), (Emap3, 2)):
+        rows = []
+        for j in range(numpy.shape(Emap)[0] // size):
+            rows.append([numpy.max(Emap[j * size:(j + 1) * size, k * size:(k + 1) * size])
+                         for k in range(numpy.shape(Emap)[1] // size)])
+        Emax.append(rows)
+    Emax1, Emax2, Emax3 = Emax
+    N_rg = 0
+    N_brg = 0
+    for j in range(len(Emax1)):
+        for k in range(len(Emax1[j])):
+            e1, e2, e3 = Emax1[j][k], Emax2[j][k], Emax3[j][k]
+            if e1 > thresh or e2 > thresh or e3 > thresh:
+                if (e1 < e2 and e2 < e3) or (e2 > e1 and e2 > e3):
+                    N_rg += 1
+                    if e1 < thresh:
+                        N_brg += 1
+    return float(N_brg) / N_rg if N_rg else 0.0
+
+
+def bench_blur(args, log):
+    import numpy
+    from blurdetect3 import blur_extent
+    file_paths = [os.path.join(path, name) for path, _, names in os.walk(args.folder)
+                  for name in names if name.endswith(".jpg")]
+    frames = [numpy.asarray(Image.open(file_path).convert('F')) for file_path in file_paths]
+    for name, function in (("loops", blur_extent_loops), ("numpy", blur_extent)):
+        start = time.perf_counter()
+        scores = [function(frame) for frame in frames]
+        seconds = time.perf_counter() - start
+        report("blur " + name, len(frames), seconds)
+        print("    %.1f ms per frame, scores %s" % (
+            seconds * 1000 / len(frames), " ".join("%.3f" % score for score in scores[:4])))
+
+
+def score_blur_scale(file_paths, analysis_width):
+    """blur_scale worker, scores file_paths in a process of its own and returns the scores,
+       the seconds taken and the growth of its peak resident memory in bytes, which takes
+       in the decoding buffers of PIL. Without the resource module, on Windows, only the
+       memory allocated by Python and numpy is traced instead."""
+    from blurdetect3 import blur_extent, open_gray
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        unit = 1 if sys.platform == "darwin" else 1024
+        idle = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    else:
+        tracemalloc.start()
+    scores = []
+    start = time.perf_counter()
+    for file_path in file_paths:
+        scores.append(blur_extent(open_gray(file_path, analysis_width)))
+    seconds = time.perf_counter() - start
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit - idle
+    else:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return scores, seconds, peak
+
+
+def bench_blur_scale(args, log):
+    import numpy
+    folder_path = os.path.expanduser(args.sample) if args.sample else args.folder
+    file_paths = sorted(os.path.join(path, name) for path, _, names in os.walk(folder_path)
+                        for name in names if name.lower().endswith((".jpg", ".jpeg")))
+    file_paths = file_paths[:args.max_images]
+
+    def score_all(analysis_width):
+        # a fresh process per width, its peak memory is not that of an earlier width
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            scores, seconds, peak = pool.apply(score_blur_scale, (file_paths, analysis_width))
+        return numpy.array(scores), seconds, peak
+
+    full, full_seconds, full_peak = score_all(None)
+    report("blur full size", len(file_paths), full_seconds)
+    print("    %.1f ms per image, peak memory +%.1f MB" % (
+        full_seconds * 1000 / len(file_paths), full_peak / 1024 / 1024))
+    for analysis_width in args.widths:
+        scores, seconds, peak = score_all(analysis_width)
+        report("blur width %d" % analysis_width, len(file_paths), seconds)
+        difference = numpy.abs(scores - full)
+        correlation = numpy.corrcoef(scores, full)[0, 1] if len(file_paths) > 1 else 1.0
+        flips = numpy.count_nonzero((scores > args.max_blur) != (full > args.max_blur))
+        print("    %.1f ms per image, peak memory +%.1f MB, |score - full| mean %.3f max %.3f, "
+              "correlation %.3f, %d of %d decisions at %.2f differ" % (
+                  seconds * 1000 / len(file_paths), peak / 1024 / 1024, difference.mean(),
+                  difference.max(), correlation, flips, len(file_paths), args.max_blur))
+
+
+def make_track_records(frames, passes, spacing=5.0):
+    """removedupes3.ImageRecords of frames images every spacing meters along a ring road
+       driven passes times the same way round, with a meter of GPS noise"""
+    import datetime
+    import random
+    from math import cos, degrees, pi, radians, sin
+    from removedupes3 import ImageRecord
+    rng = random.Random(1)
+    per_pass = frames // passes
+    radius = per_pass * spacing / (2 * pi)
+    start = datetime.datetime(2019, 5, 17, 9, 0, 0)
+    records = []
+    for i in range(frames):
+        angle = 2 * pi * (i % per_pass) / per_pass
+        north = radius * cos(angle) + rng.gauss(0, 1)
+        east = radius * sin(angle) + rng.gauss(0, 1)
+        records.append(ImageRecord(file_path="%07d.jpg" % i,
+                                   capture_time=start + datetime.timedelta(seconds=i),
+                                   lat=52.5 + north / 111195.0,
+                                   lon=13.4 + east / (111195.0 * cos(radians(52.5))),
+                                   speed=None, direction=(degrees(angle) + 90 + rng.gauss(0, 3)) % 360,
+                                   gps_time=None))
+    return records
+
+
+def bench_dupes(args, log):
+    from removedupes3 import GPSDistanceDuplicateFinder, GPSSpatialDuplicateFinder
+    records = make_track_records(args.frames, args.passes)
+    for name, finder in (("previous only", GPSDistanceDuplicateFinder(args.distance)),
+                         ("whole capture", GPSSpatialDuplicateFinder(args.distance, args.heading))):
+        duplicates = 0
+        start = time.perf_counter()
+        for record in records:
+            is_duplicate = finder.is_duplicate(record)
+            finder.latest_is_duplicate(is_duplicate)
+            duplicates += bool(is_duplicate)
+        report("dupes " + name, len(records), time.perf_counter() - start)
+        print("    %d duplicates" % duplicates)
+
+
+def bench_gps(args, log):
+    import datetime
+    import numpy
+    import gpsarrays3
+    from removedupes3 import GPSDistance, GPSSpeedErrorFinder, ImageRecord
+    try:
+        from sequencesplit3 import compute_bearing, gps_distance
+    except ImportError as error:
+        print("    sequencesplit3 needs exifread, not comparing its functions: " + str(error))
+        compute_bearing = gps_distance = None
+    records = make_track_records(args.points, 1)
+    # every 1000th frame jumps away, to have errors to find
+    records = [r._replace(lat=r.lat + 0.01) if i % 1000 == 500 else r
+               for i, r in enumerate(records)]
+    start = datetime.datetime(2019, 5, 17, 9, 0, 0)
+    records = [r._replace(speed=40.0, gps_time=start + datetime.timedelta(seconds=i))
+               for i, r in enumerate(records)]
+    lat = numpy.array([r.lat for r in records])
+    lon = numpy.array([r.lon for r in records])
+    pairs = list(zip(lat.tolist()[:-1], lon.tolist()[:-1], lat.tolist()[1:], lon.tolist()[1:]))
+
+    def compare(name, loop, arrays):
+        start = time.perf_counter()
+        expected = numpy.array(loop())
+        loop_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        result = arrays()
+        array_seconds = time.perf_counter() - start
+        report(name + " loop", len(pairs), loop_seconds)
+        report(name + " numpy", len(pairs), array_seconds)
+        print("    %.0fx faster, max difference %.2g" % (
+            loop_seconds / array_seconds, numpy.max(numpy.abs(result - expected))))
+
+    compare("haversine", lambda: [GPSDistance.get_gps_distance(*p) for p in pairs],
+            lambda: gpsarrays3.haversine_distance(lat[:-1], lon[:-1], lat[1:], lon[1:]))
+    if gps_distance is not None:
+        compare("ecef distance", lambda: [gps_distance(p[0:2], p[2:4]) for p in pairs],
+                lambda: gpsarrays3.step_distances(lat, lon))
+        compare("bearing", lambda: [compute_bearing(*p) for p in pairs],
+                lambda: gpsarrays3.step_bearings(lat, lon))
+
+    finder = GPSSpeedErrorFinder(150, 200)
+    start = time.perf_counter()
+    finder.prepare(records)
+    report("speed errors", len(records), time.perf_counter() - start)
+    print("    %d errors" % sum(finder.is_error(r) for r in records))
+
+
+def forget_uploads(folder_path):
+    """removes the session files, so the next run uploads everything again"""
+    for path, _, names in os.walk(folder_path):
+        for name in names:
+            if name in ("session.json", "session.journal", "uploadindex.sqlite"):
+                os.remove(os.path.join(path, name))
+
+
+def bench_upload(args, log):
+    log.setLevel(logging.INFO)
+    import tinyuploader3
+    from uploadserver3 import UploadServer
+    server = UploadServer(latency=args.latency, bandwidth=args.bandwidth,
+                          session_latency=args.session_latency).start()
+    tinyuploader3.api_url = server.api_url
+    try:
+        for prefetch in args.prefetch:
+            for concurrency in args.concurrency:
+                forget_uploads(args.folder)
+                server.counters.clear()
+                start = time.perf_counter()
+                tinyuploader3.upload_folder(args.folder, False, log, concurrency=concurrency,
+                                            parallel_sessions=args.sessions,
+                                            access_token="benchmark", prefetch_sessions=prefetch,
+                                            use_index=args.index,
+                                            index_path=args.folder + os.sep + "uploadindex.sqlite")
+                report("upload concurrency=%d prefetch=%d" % (concurrency, prefetch), args.images,
+                       time.perf_counter() - start)
+                print("    server: " + str(server.counters))
+    finally:
+        server.shutdown()
+
+
+def bench_upload_memory(args, log):
+    import tinyuploader3
+    from uploadserver3 import UploadServer
+    server = UploadServer(latency=args.latency).start()
+    tinyuploader3.api_url = server.api_url
+    client = tinyuploader3.UploadClient(
+        "benchmark", pool_size=args.concurrency)
+    file_paths = [os.path.join(path, name) for path, _, names in os.walk(args.folder)
+                  for name in names if name.endswith(".jpg")]
+    total_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+    print("%d images, %.1f MB" % (len(file_paths), total_bytes / 1024 / 1024))
+    try:
+        session = client.create_session(args.folder, log)
+        for streaming in (False, True):
+            http = client._http
+            tracemalloc.start()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as executor:
+                list(executor.map(lambda file_path: tinyuploader3.upload_image(
+                    session, file_path, http, streaming), file_paths))
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report("upload streaming=%s" % streaming, len(file_paths), seconds)
+            print("    peak python memory: %.1f MB with %d in flight" %
+                  (peak / 1024 / 1024, args.concurrency))
+    finally:
+        client.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the processing stages.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--images', type=int, default=200,
+                        help='number of synthetic images')
+    parser.add_argument('--dirs', type=int, default=4,
+                        help='number of directories the images are spread over')
+    parser.add_argument('--size', type=int, nargs=2, default=[640, 480],
+                        help='width and height of the synthetic images')
+    subparsers = parser.add_subparsers(dest="stage")
+    subparsers.required = True
+
+    tagging = subparsers.add_parser('tagging', help='process_image_tags')
+    tagging.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4],
+                         help='process counts to compare')
+    tagging.add_argument('--batch', action="store_true",
+                         help='read the tags with one exiftool call')
+    tagging.set_defaults(func=bench_tagging)
+
+    optimize = subparsers.add_parser('optimize', help='optimize_folder')
+    optimize.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4],
+                          help='process counts to compare')
+    optimize.add_argument('--max_width', type=int, default=None,
+                          help='shrink the images to this width')
+    optimize.add_argument('--target_kb', type=float, default=None,
+                          help='size budget per image in KB')
+    optimize.add_argument('--target_bpp', type=float, default=None,
+                          help='size budget in bits per pixel')
+    optimize.set_defaults(func=bench_optimize)
+
+    tag_optimize = subparsers.add_parser(
+        'tag_optimize', help='process_image_tags then optimize_folder vs. both in one write')
+    tag_optimize.set_defaults(func=bench_tag_optimize)
+
+    blur = subparsers.add_parser(
+        'blur', help='blurdetect3.blur_extent against the block loops it replaced, e.g. --size 4000 3000')
+    blur.set_defaults(func=bench_blur)
+
+    blur_scale = subparsers.add_parser(
+        'blur_scale', help='blur scores of downscaled JPEG decodes against the full size scores')
+    blur_scale.add_argument('--sample', default=None,
+                            help='folder of real images to calibrate on instead of the synthetic ones')
+    blur_scale.add_argument('--max_images', type=int, default=100,
+                            help='number of images of the sample to score')
+    blur_scale.add_argument('--widths', type=int, nargs='+', default=[2000, 1000, 500],
+                            help='analysis widths to compare')
+    blur_scale.add_argument('--max_blur', type=float, default=0.5,
+                            help='threshold whose decisions are compared')
+    blur_scale.set_defaults(func=bench_blur_scale)
+
+    dupes = subparsers.add_parser(
+        'dupes', help='removedupes3 duplicate finders on a street driven several times, no images')
+    dupes.add_argument('--frames', type=int, default=100000,
+                       help='number of frames of all passes')
+    dupes.add_argument('--passes', type=int, default=2,
+                       help='times the street is driven')
+    dupes.add_argument('--distance', type=float, default=3,
+                       help='meters within which a frame is a duplicate')
+    dupes.add_argument('--heading', type=float, default=20,
+                       help='degrees of heading within which a frame is a duplicate')
+    dupes.set_defaults(func=bench_dupes)
+
+    gps = subparsers.add_parser(
+        'gps', help='gpsarrays3 against the per point GPS math, no images, needs exifread')
+    gps.add_argument('--points', type=int, default=1000000,
+                     help='number of track points')
+    gps.set_defaults(func=bench_gps)
+
+    upload = subparsers.add_parser(
+        'upload', help='upload_folder against a local stand-in server')
+    upload.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help='images in flight per session to compare')
+    upload.add_argument('--sessions', type=int, default=1,
+                        help='directories uploaded at once')
+    upload.add_argument('--index', action="store_true",
+                        help='hash the images and check them against an upload index')
+    upload.add_argument('--prefetch', type=int, nargs='+', default=[2],
+                        help='directories whose session is opened ahead to compare')
+    upload.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the stand-in takes to answer an image post')
+    upload.add_argument('--session_latency', type=float, default=0.0,
+                        help='seconds the stand-in takes to open or publish a session')
+    upload.add_argument('--bandwidth', type=float, default=None,
+                        help='bytes per second per request of the stand-in')
+    upload.set_defaults(func=bench_upload)
+
+    upload_memory = subparsers.add_parser(
+        'upload_memory', help='peak memory of concurrent image posts, buffered vs streamed')
+    upload_memory.add_argument('--concurrency', type=int, default=32,
+                               help='images in flight')
+    upload_memory.add_argument('--latency', type=float, default=0.2,
+                               help='seconds the stand-in takes to answer an image post')
+    upload_memory.set_defaults(func=bench_upload_memory)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    log = logging.getLogger(__name__)
+
+    args.folder = tempfile.mkdtemp(prefix="mapillary_benchmark_")
+    try:
+        make_sample_images(args.folder, args.images,
+                           args.size[0], args.size[1], args.dirs)
+        args.func(args, log)
+    finally:
+        shutil.rmtree(args.folder)
@@ -0,0 +1,235 @@
+#
+#   file: blurfilter3.py
+#
+#   purpose: move blurry images aside before they are optimized and uploaded.
+#            The BlurExtent of blurdetect3 is computed in a pool of processes
+#            and kept in a local SQLite file by the hash of the image data, so
+#            a rerun with another threshold, or after renaming or retagging,
+#            does not decode the images again. An analysis width scores a
+#            JPEG decoded at 1/2 .. 1/8 of its size, see blurdetect3.open_gray.
+#
+
+import functools
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+from tqdm import tqdm
+
+import blurdetect3
+from atomicwrite3 import get_writer, init_worker, worker_args
+from scanner3 import scan_folder
+from uploadindex3 import image_data_hash
+from workerlog3 import replay, worker_log
+
+
+def default_cache_path():
+    """next to the scripts, like the uploadindex3 index"""
+    return os.path.dirname(os.path.realpath(sys.argv[0])) + os.sep + "blurscores3.sqlite"
+
+
+def score_file(file_path, analysis_width=None):
+    """returns the BlurExtent of an image file, at analysis_width if given"""
+    return blurdetect3.blur_extent(blurdetect3.open_gray(file_path, analysis_width))
+
+
+class BlurScoreCache:
+    """BlurExtent of every image scored, by the hash of its image data, the
+    edge threshold and the analysis width used, 0 for full size. The hash
+    of a path is remembered with its size and mtime, so an unchanged file
+    is looked up without reading it. Inserts are committed every batch_size
+    rows and on close(), like the uploadindex3.UploadIndex."""
+
+    def __init__(self, path=None, analysis_width=None, batch_size=32):
+        self.path = path or default_cache_path()
+        self.analysis_width = analysis_width
+        self._batch_size = batch_size
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS scores ("
+                         "hash TEXT, thresh REAL, width INTEGER, score REAL, "
+                         "PRIMARY KEY (hash, thresh, width))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+        self._db.commit()
+
+    def file_hash(self, file_path):
+        """the image_data_hash of file_path, computed only if the file changed"""
+        stat = os.stat(file_path)
+        path = os.path.abspath(file_path)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, hash FROM files WHERE path = ?",
+                                   (path,)).fetchone()
+        if row is not None and row[0:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        data_hash = image_data_hash(file_path)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                             (path, stat.st_size, stat.st_mtime_ns, data_hash))
+            self._inserted()
+        return data_hash
+
+    def lookup(self, data_hash):
+        with self._lock:
+            row = self._db.execute("SELECT score FROM scores WHERE hash = ? AND thresh = ? AND width = ?",
+                                   (data_hash, blurdetect3.thresh, self.analysis_width or 0)).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, data_hash, score):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                             (data_hash, blurdetect3.thresh, self.analysis_width or 0, score))
+            self._inserted()
+
+    def _inserted(self):
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+
+def cached_score(file_path, cache):
+    """the BlurExtent of file_path from the BlurScoreCache cache, scored and added if missing"""
+    read_path = get_writer().current(file_path)
+    data_hash = cache.file_hash(read_path)
+    score = cache.lookup(data_hash)
+    if score is None:
+        score = score_file(read_path, cache.analysis_width)
+        cache.add(data_hash, score)
+    return score
+
+
+def score_chunk(chunk, log_level=logging.INFO, analysis_width=None):
+    """process pool worker, scores a chunk of (file path, path to read) pairs
+       returns (file path, score or None) pairs and the log records
+    """
+    log, records = worker_log(__name__, log_level)
+    results = []
+    for file_path, read_path in chunk:
+        try:
+            results.append((file_path, score_file(read_path, analysis_width)))
+        except Exception as error:
+            log.error("blur scoring failed: " + file_path + ": " + repr(error))
+            results.append((file_path, None))
+    return results, records
+
+
+def set_aside(folder_path, file_path, manifest, log):
+    """moves a blurry image to the same place below folder_path + "_blurry", which
+       no stage scans, an image of the source tree is only left out when writing
+       to an output tree
+    """
+    writer = get_writer()
+    current = writer.current(file_path)
+    if current != writer.destination(file_path):
+        log.info("leaving out blurry image: " + file_path)
+    else:
+        target = os.path.normpath(folder_path) + "_blurry" + os.sep + \
+            os.path.relpath(file_path, folder_path)
+        log.info("moving blurry image: " + file_path + " -> " + target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(current, target)
+    if manifest is not None:
+        manifest.remove(file_path)
+
+
+def filter_blurry(folder_path, dry_run, log, max_blur, manifest=None, jobs=1, chunk_size=8,
+                  cache_path=None, analysis_width=None):
+    """moves the images of the scanner3.Manifest of folder_path, scanned if not given,
+       whose BlurExtent exceeds max_blur aside, see set_aside()
+       the scores are computed in a pool of jobs processes, unless found in the
+       BlurScoreCache at cache_path, next to the scripts if not given
+       with analysis_width, the JPEGs are scored at about that width, see blurdetect3.open_gray
+       returns the number of images moved aside
+    """
+    if dry_run:
+        log.warning(
+            "*** DRY RUN, NOT ACTUALLY MOVING ANY IMAGERY, THE FOLLOWING IS SAMPLE OUTPUT")
+    log.info("   *** Blur filter ***")
+    if not(os.path.isdir(folder_path)):
+        log.warning("No valid directory given as parameter.")
+        return 0
+
+    if manifest is None:
+        manifest = scan_folder(folder_path)
+    entries = manifest.entries()
+    writer = get_writer()
+    cache = BlurScoreCache(cache_path, analysis_width)
+    start = time.perf_counter()
+
+    # the cached scores first, they need no decoding
+    scores = {}
+    hashes = {}
+    pending = []
+    for entry in tqdm(entries, desc="blur cache", dynamic_ncols=True):
+        try:
+            hashes[entry.path] = cache.file_hash(writer.current(entry.path))
+        except Exception as error:
+            log.error("blur scoring failed: " + entry.path + ": " + repr(error))
+            continue
+        score = cache.lookup(hashes[entry.path])
+        if score is None:
+            pending.append((entry.path, writer.current(entry.path)))
+        else:
+            scores[entry.path] = score
+    log.info("   *** " + str(len(scores)) + " blur scores cached, scoring " +
+             str(len(pending)) + " images")
+
+    total_pbar = tqdm(total=len(pending), desc="blur", dynamic_ncols=True)
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    worker = functools.partial(score_chunk, log_level=log.getEffectiveLevel(),
+                               analysis_width=analysis_width)
+    try:
+        if jobs > 1 and len(chunks) > 1:
+            with multiprocessing.Pool(jobs, initializer=init_worker,
+                                      initargs=worker_args()) as pool:
+                results = pool.imap_unordered(worker, chunks)
+                add_scores(results, scores, hashes, cache, total_pbar, log)
+        else:
+            add_scores(map(worker, chunks), scores, hashes, cache, total_pbar, log)
+    finally:
+        total_pbar.close()
+        cache.close()
+
+    blurry = [entry.path for entry in entries
+              if scores.get(entry.path) is not None and scores[entry.path] > max_blur]
+    for file_path in blurry:
+        if dry_run:
+            log.info("blurry image: " + file_path + " (" + "%.3f" % scores[file_path] + ")")
+        else:
+            set_aside(folder_path, file_path, manifest, log)
+    log.info("   *** " + str(len(blurry)) + " of " + str(len(entries)) + " images blurrier than " +
+             str(max_blur) + " in " + "%.1f s" % (time.perf_counter() - start))
+    return len(blurry)
+
+
+def add_scores(results, scores, hashes, cache, total_pbar, log):
+    for chunk_results, records in results:
+        replay(log, records)
+        for file_path, score in chunk_results:
+            if score is not None:
+                scores[file_path] = score
+                cache.add(hashes[file_path], score)
+        total_pbar.update(len(chunk_results))
+
+
+#
+#   Main
+#
+if __name__ == "__main__":
+    filter_blurry(sys.argv[1], False, logging.getLogger(__name__), float(sys.argv[2]))
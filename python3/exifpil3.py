@@ -1,7 +1,9 @@
 import ast
 import datetime
+import os
 import pprint
 import subprocess
+import threading
 
 # import struct  # Only to catch struct.error due to error in PIL / Pillow.
 from PIL import Image
@@ -20,11 +22,144 @@ class ExifException(Exception):
         return self._message
 
 
+class ExifToolWorker:
+    """One long-lived `exiftool -stay_open True -@ -` process.
+    Arguments are written to stdin one per line, followed by a numbered
+    -execute, and the output is read back up to the matching {ready} line."""
+
+    def __init__(self, executable="exiftool"):
+        self._process = subprocess.Popen([executable, "-stay_open", "True", "-@", "-"],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+        self._counter = 0
+
+    def execute(self, *args):
+        self._counter += 1
+        sentinel = ("{ready%d}" % self._counter).encode("utf-8")
+        request = "\n".join(args) + "\n-execute%d\n" % self._counter
+        self._process.stdin.write(request.encode("utf-8"))
+        self._process.stdin.flush()
+        output = []
+        while True:
+            line = self._process.stdout.readline()
+            if line == b"":
+                raise ExifException("exiftool terminated unexpectedly")
+            if line.rstrip() == sentinel:
+                break
+            output.append(line)
+        return b"".join(output).decode("utf-8").rstrip()
+
+    def close(self):
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.write(b"-stay_open\nFalse\n")
+                self._process.stdin.flush()
+                self._process.stdin.close()
+                self._process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+
+
+class ExifToolPool:
+    """Thread safe pool of ExifToolWorker processes, started on demand.
+    A caller waiting for a worker is woken when one is returned, when a
+    dead one leaves room for a new one, or by close()."""
+
+    def __init__(self, size=2, executable="exiftool"):
+        self._size = size
+        self._executable = executable
+        self._idle = []
+        self._workers = []
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._closed = False
+
+    def _acquire(self):
+        with self._available:
+            while True:
+                if self._closed:
+                    raise ExifException("exiftool pool is shut down")
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._workers) < self._size:
+                    worker = ExifToolWorker(self._executable)
+                    self._workers.append(worker)
+                    return worker
+                self._available.wait()
+
+    def execute(self, *args):
+        worker = self._acquire()
+        try:
+            output = worker.execute(*args)
+        except Exception:
+            # a worker in an unknown protocol state can not be reused
+            worker.close()
+            with self._available:
+                if worker in self._workers:
+                    self._workers.remove(worker)
+                self._available.notify()
+            raise
+        with self._available:
+            if worker in self._workers:
+                self._idle.append(worker)
+                self._available.notify()
+        return output
+
+    def close(self):
+        with self._available:
+            self._closed = True
+            workers = self._workers
+            self._workers = []
+            self._idle = []
+            self._available.notify_all()
+        for worker in workers:
+            worker.close()
+
+
+_exiftool_pool = None
+_exiftool_pool_lock = threading.Lock()
+
+
+def get_exiftool_pool():
+    global _exiftool_pool
+    with _exiftool_pool_lock:
+        if _exiftool_pool is None:
+            _exiftool_pool = ExifToolPool()
+        return _exiftool_pool
+
+
+def shutdown_exiftool_pool():
+    global _exiftool_pool
+    with _exiftool_pool_lock:
+        if _exiftool_pool is not None:
+            _exiftool_pool.close()
+            _exiftool_pool = None
+
+
+def _forget_exiftool_pool():
+    # a forked child shares the pipes of the parent's workers, it has to
+    # start its own instead of talking to (or closing) the parent's ones
+    global _exiftool_pool, _exiftool_pool_lock
+    _exiftool_pool = None
+    _exiftool_pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_exiftool_pool)
+
+
 class PILExifReader:
-    def __init__(self, filepath):
+    def __init__(self, filepath, image=None):
+        """image is filepath already opened by PIL, it is left open for the caller"""
         self._filepath = filepath
+        if image is not None:
+            self._exif = self.get_exif_data(image)
+            self._exif_bytes = image.info.get("exif")
+            return
         with Image.open(filepath) as image:
             self._exif = self.get_exif_data(image)
+            self._exif_bytes = image.info.get("exif")
 
     @staticmethod
     def get_exif_data(image):
@@ -99,26 +234,16 @@ class PILExifReader:
         return True
 
     def remove_XMP_description(self):
-        subprocess.Popen(["exiftool", "-XMP:ALL=", self._filepath],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        get_exiftool_pool().execute("-XMP:ALL=", self._filepath)
 
     def get_exif_log(self):
-        sub = subprocess.Popen(["exiftool", self._filepath, "-G0:2"],
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = sub.communicate("")
-        return output.decode("utf-8").rstrip()
+        return get_exiftool_pool().execute(self._filepath, "-G0:2")
 
     def get_XMP_description(self):
-        sub = subprocess.Popen(["exiftool", "-s", "-s", "-s", "-description", self._filepath],
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = sub.communicate("")
-        return output.decode("utf-8").rstrip()
+        return get_exiftool_pool().execute("-s", "-s", "-s", "-description", self._filepath)
 
     def get_datetimeoriginal(self):
-        sub = subprocess.Popen(["exiftool", "-s", "-s", "-s", "-datetimeoriginal", self._filepath],
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = sub.communicate("")
-        return output.decode("utf-8").rstrip()
+        return get_exiftool_pool().execute("-s", "-s", "-s", "-datetimeoriginal", self._filepath)
 
     def read_capture_time(self):
         """
@@ -138,6 +263,11 @@ class PILExifReader:
                 print("No time tag in " + self._filepath)
                 return None
 
+        return self.parse_capture_time(capture_time)
+
+    @staticmethod
+    def parse_capture_time(capture_time):
+        """Parses an EXIF time string like 2019:05:17 09:14:09 into a datetime"""
         if len(capture_time) < 23:
             capture_time += "1970_01_01_00_00_00_000"[len(capture_time):]
 
@@ -146,6 +276,10 @@ class PILExifReader:
         # return as datetime object
         return datetime.datetime.strptime(capture_time, '%Y_%m_%d_%H_%M_%S_%f')
 
+    def get_exif_bytes(self):
+        """Returns the raw EXIF segment (starting with Exif\\0\\0) or None"""
+        return self._exif_bytes
+
     def get_exif_tag(self, key_name):
         if key_name in self._exif:
             return self._exif[key_name]
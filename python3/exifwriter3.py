@@ -0,0 +1,91 @@
+#
+#   file: exifwriter3.py
+#
+#   purpose: replace the APP1/EXIF segment of a JPEG without decoding or
+#            rewriting the rest of the file. The segment is patched in place
+#            when the new EXIF fits into the old one, otherwise the file is
+#            written once as a streamed copy with the new segment spliced in,
+#            through the atomicwrite3.AtomicWriter of the stages.
+#
+
+import shutil
+import struct
+
+from atomicwrite3 import get_writer
+from exifpil3 import ExifException
+
+EXIF_HEADER = b"Exif\x00\x00"
+# the segment length field counts itself, but is only 16 bit wide
+MAX_EXIF_LENGTH = 0xFFFF - 2
+
+
+def find_exif_segment(f):
+    """Scans the JPEG markers of f up to the start of scan.
+    Returns offset and length (marker included) of the APP1 Exif segment,
+    or the offset to insert one at and a length of 0 if there is none."""
+    f.seek(0)
+    if f.read(2) != b"\xff\xd8":
+        raise ExifException("not a JPEG file: " + str(f.name))
+    offset = 2
+    insert_offset = 2
+    while True:
+        head = f.read(4)
+        if len(head) < 4 or head[0] != 0xFF:
+            raise ExifException("broken JPEG marker in " + str(f.name))
+        marker = head[1]
+        if marker == 0xDA:  # start of scan, no more metadata
+            return insert_offset, 0
+        length = struct.unpack(">H", head[2:4])[0]
+        if marker == 0xE1 and f.read(6) == EXIF_HEADER:
+            return offset, length + 2
+        if marker == 0xE0 and offset == 2:
+            # keep a leading JFIF APP0 segment in front of the EXIF
+            insert_offset = offset + length + 2
+        offset += length + 2
+        f.seek(offset)
+
+
+def read_exif_bytes(filepath):
+    """Returns the EXIF bytes (starting with Exif\\0\\0) of a JPEG or None,
+    reading only the segments in front of the image data."""
+    with open(filepath, "rb") as f:
+        offset, length = find_exif_segment(f)
+        if length == 0:
+            return None
+        f.seek(offset + 4)
+        return f.read(length - 4)
+
+
+def write_exif_bytes(filepath, exif_bytes, writer=None):
+    """Replaces the EXIF segment of filepath with exif_bytes as returned by piexif.dump.
+    The in place patch is a single write into the header that cannot truncate
+    the file, copies go through writer, the AtomicWriter of get_writer() if
+    not given, also when it writes to an output tree.
+    Returns True if the segment was patched in place, False if the file was copied."""
+    if exif_bytes[0:6] != EXIF_HEADER:
+        raise ExifException("given data is not exif data")
+    if len(exif_bytes) > MAX_EXIF_LENGTH:
+        raise ExifException("exif data too large for one APP1 segment: " +
+                            str(len(exif_bytes)) + " bytes")
+
+    if writer is None:
+        writer = get_writer()
+    source = writer.current(filepath)
+    in_place = source == writer.destination(filepath)
+    with open(source, "r+b" if in_place else "rb") as f:
+        offset, length = find_exif_segment(f)
+        if in_place and 0 < len(exif_bytes) + 4 <= length:
+            # TIFF readers ignore bytes behind the IFDs, so a shorter EXIF is padded
+            padded = exif_bytes + b"\x00" * (length - 4 - len(exif_bytes))
+            f.seek(offset)
+            f.write(b"\xff\xe1" + struct.pack(">H", len(padded) + 2) + padded)
+            return True
+
+        segment = b"\xff\xe1" + struct.pack(">H", len(exif_bytes) + 2) + exif_bytes
+        with writer.replace(filepath) as out:
+            f.seek(0)
+            out.write(f.read(offset))
+            out.write(segment)
+            f.seek(offset + length)
+            shutil.copyfileobj(f, out, 1024 * 1024)
+    return False
@@ -0,0 +1,91 @@
+#
+#   file: gpsarrays3.py
+#
+#   purpose: the GPS math of removedupes3 and sequencesplit3 on whole columns
+#            of latitudes, longitudes and times at once. Every function takes
+#            numpy arrays (or anything numpy.asarray takes) of degrees and
+#            returns an array, so a sequence is one call instead of a Python
+#            loop over its frames. The results match the scalar versions.
+#
+
+import numpy
+
+# radius of the sphere of removedupes3.GPSDistance.get_gps_distance
+EARTH_RADIUS = 6371000.0
+# the ellipsoid of sequencesplit3.ecef_from_lla
+WGS84_a = 6378137.0
+WGS84_b = 6356752.314245
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """great circle distances in meters between the points of two columns, like
+       removedupes3.GPSDistance.get_gps_distance"""
+    lat1, lon1, lat2, lon2 = map(numpy.radians, (lat1, lon1, lat2, lon2))
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + \
+        numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(a))
+
+
+def ecef_from_lla(lat, lon, alt=0.0):
+    """x, y, z columns in meters on the WGS84 ellipsoid, like sequencesplit3.ecef_from_lla"""
+    lat = numpy.radians(lat)
+    lon = numpy.radians(lon)
+    a2 = WGS84_a ** 2
+    b2 = WGS84_b ** 2
+    cos_lat = numpy.cos(lat)
+    sin_lat = numpy.sin(lat)
+    L = 1.0 / numpy.sqrt(a2 * cos_lat ** 2 + b2 * sin_lat ** 2)
+    x = (a2 * L + alt) * cos_lat * numpy.cos(lon)
+    y = (a2 * L + alt) * cos_lat * numpy.sin(lon)
+    z = (b2 * L + alt) * sin_lat
+    return x, y, z
+
+
+def ecef_distance(lat1, lon1, lat2, lon2):
+    """straight distances in meters between the points of two columns, like
+       sequencesplit3.gps_distance"""
+    x1, y1, z1 = ecef_from_lla(lat1, lon1)
+    x2, y2, z2 = ecef_from_lla(lat2, lon2)
+    return numpy.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2 + (z1 - z2) ** 2)
+
+
+def step_distances(lat, lon):
+    """ecef_distance from every point of a track to the next, one shorter than the track"""
+    x, y, z = ecef_from_lla(lat, lon)
+    return numpy.sqrt(numpy.diff(x) ** 2 + numpy.diff(y) ** 2 + numpy.diff(z) ** 2)
+
+
+def compute_bearing(start_lat, start_lon, end_lat, end_lon):
+    """compass bearings in degrees from the start to the end points, like
+       sequencesplit3.compute_bearing"""
+    start_lat, start_lon, end_lat, end_lon = map(
+        numpy.radians, (start_lat, start_lon, end_lat, end_lon))
+    # the longitude difference the short way round
+    dLong = (end_lon - start_lon + numpy.pi) % (2 * numpy.pi) - numpy.pi
+    y = numpy.sin(dLong) * numpy.cos(end_lat)
+    x = numpy.cos(start_lat) * numpy.sin(end_lat) - \
+        numpy.sin(start_lat) * numpy.cos(end_lat) * numpy.cos(dLong)
+    return (numpy.degrees(numpy.arctan2(y, x)) + 360.0) % 360.0
+
+
+def step_bearings(lat, lon):
+    """compute_bearing from every point of a track to the next, one shorter than the track"""
+    lat = numpy.asarray(lat, dtype=float)
+    lon = numpy.asarray(lon, dtype=float)
+    return compute_bearing(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def time_deltas(times):
+    """seconds from every datetime.datetime of a column to the next, one shorter than it,
+       like timedelta.total_seconds"""
+    microseconds = numpy.array(times, dtype="datetime64[us]").astype(numpy.int64)
+    return numpy.diff(microseconds) / 1e6
+
+
+def implied_speed(distances, seconds):
+    """km/h of covering distances in meters in seconds, nan where no time passed"""
+    distances = numpy.asarray(distances, dtype=float)
+    seconds = numpy.asarray(seconds, dtype=float)
+    speed = numpy.full(numpy.shape(distances), numpy.nan)
+    numpy.divide(distances, seconds, out=speed, where=seconds != 0)
+    return speed * 3.6
@@ -4,41 +4,397 @@
 #   coder: geomoenk@googlemail.com
 #
 #   purpose: optimize all JPG files with EXIF headers from a directory
-#            to 75% quality using OpenCV and Pillow before uploading
+#            to 75% quality using OpenCV and Pillow before uploading,
+#            optionally shrinking them like the normalizer of
+#            bash/mapillary_uploader.sh within the same decode
 #
-#   warning: deletes all broken pictures!
+#   warning: deletes all broken pictures! Only images PIL cannot decode or
+#            without EXIF are deleted, files that cannot be read or written
+#            are left alone.
 #
 
+import collections
+import functools
+import io
 import logging
+import multiprocessing
 import os
 import pprint
 import sys
+import threading
 import time
 
-from PIL import Image, ImageOps
+from PIL import Image, ImageOps, UnidentifiedImageError
 from tqdm import tqdm
 
+from addmaptags3 import add_mapillary_tags, mapillary_exif_bytes, read_mapillary_payload
+from atomicwrite3 import get_writer, init_worker, worker_args
+from exifpil3 import PILExifReader
+from scanner3 import scan_folder
+from uploadindex3 import image_data_hash
+from workerlog3 import replay, worker_log
 
-def optimize_file(file_path, log):
-    image_org = Image.open(file_path)
+
+class BrokenImageError(Exception):
+    """PIL could not decode an image or it has no EXIF, the only reasons an image is deleted"""
+
+
+def decode_image(file_path, max_width=None):
+    """opens and decodes file_path like open_scaled, returns the original and the decoded image
+       raises BrokenImageError if the file is no image PIL can decode, an OSError of the file
+       system, like a missing permission or an I/O error, is raised as it is
+    """
     try:
-        exif_data = image_org.info['exif']
-        log.debug("exif_data: " + pprint.pformat(exif_data))
-        image_rgb = ImageOps.autocontrast(image_org)
-        image_rgb.save(file_path, optimize=True, quality=75, exif=exif_data)
+        image_org = Image.open(file_path)
+    except (UnidentifiedImageError, SyntaxError) as error:
+        raise BrokenImageError(repr(error)) from error
+    try:
+        image = open_scaled(image_org, max_width)
+        image.load()
+    except OSError as error:
+        image_org.close()
+        if error.errno is not None:
+            raise
+        # truncated or corrupt image data
+        raise BrokenImageError(repr(error)) from error
+    except (SyntaxError, ValueError) as error:
+        image_org.close()
+        raise BrokenImageError(repr(error)) from error
+    return image_org, image
+
+
+def scaled_size(size, max_width):
+    width, height = size
+    return max_width, max(1, round(height * max_width / width))
+
+
+def open_scaled(image, max_width):
+    """returns image shrunk to max_width if it is wider, decoding a JPEG at 1/2, 1/4 or 1/8
+       of its size right in the DCT where possible, so the full size image is never in memory
+    """
+    if not max_width or image.width <= max_width:
+        return image
+    size = scaled_size(image.size, max_width)
+    # draft picks the smallest scale still at least size, resize does the rest,
+    # with the resampling of Image.thumbnail
+    image.draft("RGB", size)
+    return image.resize(size, Image.BICUBIC, reducing_gap=2.0)
+
+
+def encode_jpeg(image, quality, exif_data=b"", optimize=True):
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", optimize=optimize, quality=quality, exif=exif_data)
+    return buffer.getvalue()
+
+
+def choose_quality(image, target_bytes, min_quality=30, max_quality=90, probe_width=512,
+                   correction=1.0):
+    """returns the highest quality whose encode of image is estimated to fit target_bytes and
+       that estimate, from encodes of a copy shrunk to probe_width scaled by the pixel count
+    """
+    probe = image
+    if image.width > probe_width:
+        probe = image.resize(scaled_size(image.size, probe_width), Image.BILINEAR)
+    scale = image.width * image.height / (probe.width * probe.height) * correction
+
+    def estimate(quality):
+        return len(encode_jpeg(probe, quality, optimize=False)) * scale
+
+    low, high = min_quality, max_quality
+    while low < high:
+        quality = (low + high + 1) // 2
+        if estimate(quality) <= target_bytes:
+            low = quality
+        else:
+            high = quality - 1
+    return low, estimate(low)
+
+
+def encode_to_budget(image, target_bytes, exif_data, log, min_quality=30, max_quality=90):
+    """encodes image in memory at the highest quality that fits target_bytes, EXIF included,
+       or at min_quality if none does, returns the JPEG bytes and the quality
+    """
+    budget = target_bytes - len(exif_data)
+    correction = 1.0
+    best = None
+    # every quality above high is known not to fit
+    high = max_quality
+    for _ in range(3):
+        quality, estimate = choose_quality(image, budget, min_quality, high,
+                                           correction=correction)
+        data = encode_jpeg(image, quality, exif_data)
+        size = len(data) - len(exif_data)
+        if size <= budget:
+            if best is None or quality > best[1]:
+                best = (data, quality)
+            if size >= 0.9 * budget or quality == high:
+                break
+        else:
+            high = quality - 1
+            if quality == min_quality:
+                break
+        # the probe misjudges the full image, scale its estimates by what it missed
+        correction *= size / estimate
+    if best is None:
+        # the estimates kept overshooting, bisect the qualities left with full encodes
+        low = min_quality
+        while low < high:
+            quality = (low + high + 1) // 2
+            data = encode_jpeg(image, quality, exif_data)
+            if len(data) - len(exif_data) <= budget:
+                best = (data, quality)
+                low = quality
+            else:
+                high = quality - 1
+        if best is None:
+            if quality != min_quality:
+                data = encode_jpeg(image, min_quality, exif_data)
+            best = (data, min_quality)
+    log.debug("quality " + str(best[1]) + " for " + str(len(best[0])) +
+              " of " + str(target_bytes) + " bytes")
+    return best
+
+
+def tagged_exif_bytes(file_path, image, exif_data, log):
+    """exif_data with the Mapillary ImageDescription of addmaptags3 read from image,
+       or exif_data as it is if tagging fails, which is logged
+    """
+    try:
+        payload_dict = read_mapillary_payload(PILExifReader(file_path, image), log)
+        return mapillary_exif_bytes(exif_data, payload_dict, log)
     except Exception as error:
-        log.error(error)
+        log.error("tagging failed, optimizing untagged: " + file_path + ": " + repr(error))
+        return exif_data
+
+
+def optimize_file(file_path, log, max_width=None, tag=False, target_bytes=None, target_bpp=None):
+    """re-encodes file_path at quality 75 after an autocontrast, shrunk to max_width if given
+       the file is replaced atomically through the atomicwrite3.AtomicWriter of the stages
+       with tag set, the Mapillary ImageDescription of addmaptags3 is added to the EXIF
+       written along, so the image is decoded and written once for both stages, an image
+       that cannot be tagged is optimized untagged
+       with target_bytes or target_bpp (bits per pixel) set, the quality is chosen to fit
+       that budget instead, the file is still written once
+       raises BrokenImageError if PIL cannot decode the image or it has no EXIF, any other
+       exception if it cannot be optimized otherwise, e.g. if it cannot be read or written
+    """
+    writer = get_writer()
+    image_org, image_decoded = decode_image(writer.current(file_path), max_width)
+    try:
+        exif_data = image_org.info.get('exif')
+        if exif_data is None:
+            # no capture time nor position to upload it with, removed as ever
+            raise BrokenImageError("no EXIF data")
+        if tag:
+            exif_data = tagged_exif_bytes(writer.current(file_path), image_org, exif_data, log)
+        log.debug("exif_data: " + pprint.pformat(exif_data))
+        image_rgb = ImageOps.autocontrast(image_decoded)
+        if target_bpp:
+            target_bytes = int(target_bpp * image_rgb.width * image_rgb.height / 8)
+        if target_bytes:
+            data, _ = encode_to_budget(image_rgb, target_bytes, exif_data, log)
+            with writer.replace(file_path) as f:
+                f.write(data)
+        else:
+            with writer.replace(file_path) as f:
+                image_rgb.save(f, "JPEG", optimize=True, quality=75, exif=exif_data)
+    finally:
         image_org.close()
-        return False
     return True
 
 
-def image_files(files):
-    return [f for f in files if f.lower().endswith('.jpg')
-            or f.lower().endswith('.jpeg')]
+# broken is set if the image failed because PIL cannot decode it
+OptimizeResult = collections.namedtuple(
+    "OptimizeResult", ["path", "success", "skipped", "size_before", "size_after", "record",
+                       "broken"], defaults=[False])
+
+
+def optimize_settings(max_width=None, target_bytes=None, target_bpp=None):
+    """the settings an image is optimized with as one word, "-" for the defaults"""
+    settings = []
+    if max_width:
+        settings.append("w%d" % max_width)
+    if target_bpp:
+        settings.append("p%g" % target_bpp)
+    elif target_bytes:
+        settings.append("b%d" % target_bytes)
+    return ",".join(settings) or "-"
+
+
+class OptimizeJournal:
+    """Append-only record of the optimized images of a directory, one
+    "<image data hash> <size> <mtime ns> settings=<optimize_settings> <file name>"
+    per line, the last line of a file name counts. Lines are fsynced every
+    batch_size images."""
+    file_name = "optimized.journal"
+
+    def __init__(self, path, batch_size=32):
+        self._path = path + os.sep + self.file_name
+        self._batch_size = batch_size
+        self._pending = 0
+        self._file = None
+        self.records = {}
+        if os.path.exists(self._path):
+            with open(self._path, "r") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # torn last line of a crash
+                    data_hash, size, mtime_ns, settings, name = line[:-1].split(" ", 4)
+                    self.records[name] = (data_hash, int(size), int(mtime_ns),
+                                          settings[len("settings="):])
 
+    def record(self, file_name, record):
+        if self.records.get(file_name) == record:
+            return
+        if self._file is None:
+            self._file = open(self._path, "a")
+        self._file.write("%s %d %d settings=%s %s\n" % (record + (file_name,)))
+        self.records[file_name] = record
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self.sync()
 
-def optimize_folder(folder_path, dry_run, log):
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class OptimizeCache:
+    """The OptimizeJournal of every directory, so reruns skip optimized images.
+    An image is unchanged if size and mtime are those of its record, otherwise,
+    e.g. after tagging rewrote its EXIF, the hash of its image data decides.
+    An image recorded with other optimize_settings counts as not optimized.
+    The journals and the images checked are those the AtomicWriter writes."""
+
+    def __init__(self, settings="-"):
+        self.settings = settings
+        self._journals = {}
+        self._writer = get_writer()
+        self._lock = threading.Lock()
+
+    def _journal(self, path):
+        if path not in self._journals:
+            self._journals[path] = OptimizeJournal(self._writer.destination(path))
+        return self._journals[path]
+
+    def lookup(self, file_path):
+        """returns whether file_path is unchanged since it was optimized and its record or None"""
+        with self._lock:
+            known = self._journal(os.path.dirname(file_path)).records.get(
+                os.path.basename(file_path))
+        if known is None or known[3] != self.settings:
+            return False, None
+        stat = os.stat(self._writer.current(file_path))
+        return (stat.st_size, stat.st_mtime_ns) == known[1:3], known
+
+    def add(self, result):
+        with self._lock:
+            self._journal(os.path.dirname(result.path)).record(
+                os.path.basename(result.path), result.record[0:3] + (self.settings,))
+
+    def close(self):
+        with self._lock:
+            for journal in self._journals.values():
+                journal.close()
+        self._writer.sync()
+
+
+def file_record(file_path):
+    stat = os.stat(file_path)
+    return image_data_hash(file_path), stat.st_size, stat.st_mtime_ns
+
+
+def optimize_entry(file_path, log, known=None, max_width=None, tag=False, target_bytes=None,
+                   target_bpp=None):
+    """optimizes file_path like optimize_file, unless its image data still has the hash
+       of the known record
+       with tag set, also an image not optimized again is tagged, in its EXIF segment only
+       returns an OptimizeResult, failures are logged, never raised
+    """
+    writer = get_writer()
+    size_before = 0
+    try:
+        size_before = os.path.getsize(writer.current(file_path))
+        if known is not None:
+            record = file_record(writer.current(file_path))
+            if record[0] == known[0]:
+                if tag:
+                    try:
+                        add_mapillary_tags(file_path, log)
+                    except Exception as error:
+                        log.error("tagging failed: " + file_path + ": " + repr(error))
+                    record = file_record(writer.current(file_path))
+                return OptimizeResult(file_path, True, True, size_before, record[1], record)
+        optimize_file(file_path, log, max_width, tag, target_bytes, target_bpp)
+        record = file_record(writer.current(file_path))
+    except BrokenImageError as error:
+        log.error("broken image: " + file_path + ": " + str(error))
+        return OptimizeResult(file_path, False, False, size_before, 0, None, broken=True)
+    except Exception as error:
+        log.error("optimizing failed: " + file_path + ": " + repr(error))
+        return OptimizeResult(file_path, False, False, size_before, 0, None)
+    return OptimizeResult(file_path, True, False, size_before, record[1], record)
+
+
+def optimize_worker(chunk, log_level=logging.INFO, max_width=None, tag=False, target_bytes=None,
+                    target_bpp=None):
+    """process pool worker, optimizes a chunk of (file path, known record or None) tasks
+       returns the OptimizeResults and the log records
+    """
+    log, records = worker_log(__name__, log_level)
+    results = [optimize_entry(file_path, log, known, max_width, tag, target_bytes, target_bpp)
+               for file_path, known in chunk]
+    # one batch of directory fsyncs per chunk
+    get_writer().sync()
+    return results, records
+
+
+def drop_failed_image(result, manifest, log):
+    """leaves an image that failed to optimize out of the rest of the run, it is
+       deleted by remove_broken_image() only if PIL cannot decode it or it has no EXIF
+    """
+    if result.broken:
+        remove_broken_image(result.path, manifest, log)
+        return
+    log.warning("skipping image, left as it is: " + result.path)
+    if manifest is not None:
+        manifest.remove(result.path)
+
+
+def remove_broken_image(file_path, manifest, log):
+    """deletes an image that failed to optimize and forgets it in the manifest,
+       an image of the source tree is only left out when writing to an output tree
+    """
+    writer = get_writer()
+    current = writer.current(file_path)
+    if current != writer.destination(file_path):
+        log.info("leaving out broken image: " + file_path)
+    else:
+        log.info("removing image: " + current)
+        os.remove(current)
+    if manifest is not None:
+        manifest.remove(file_path)
+
+
+def optimize_folder(folder_path, dry_run, log, manifest=None, jobs=1, reoptimize=False,
+                    max_width=None, tag=False, target_bytes=None, target_bpp=None):
+    """optimizes all JPEGs of the scanner3.Manifest of folder_path, scanned if not given,
+       images that fail are removed from the manifest, and deleted if PIL cannot decode them
+       with jobs > 1, the files are optimized in a pool of that many processes
+       images optimized by an earlier run with the same settings are skipped, unless
+       reoptimize is set, in any case the optimized images are recorded for the next run
+       images wider than max_width are shrunk to it
+       with tag set, the images are tagged like addmaptags3.process_image_tags within the same write
+       target_bytes or target_bpp set a size budget per image as in optimize_file
+    """
     if dry_run:
         log.warning(
             "*** DRY RUN, NOT ACTUALLY OPTIMIZING ANY IMAGERY, THE FOLLOWING IS SAMPLE OUTPUT")
@@ -47,14 +403,10 @@ def optimize_folder(folder_path, dry_run, log):
         log.warning("No valid directory given as parameter.")
         exit(1)
 
-    # compute totals for progress bar
-    total_images = 0
-    total_image_dirs = 0
-    for path, _, files in os.walk(folder_path):
-        new_images = len(image_files(files))
-        total_images += new_images
-        if new_images > 0:
-            total_image_dirs += 1
+    if manifest is None:
+        manifest = scan_folder(folder_path)
+    total_images = manifest.total_images
+    total_image_dirs = manifest.total_image_dirs
 
     # initialize progress bars
     total_pbar = tqdm(total=total_images, dynamic_ncols=True)
@@ -63,25 +415,107 @@ def optimize_folder(folder_path, dry_run, log):
     else:
         dirs_pbar = None
 
-    # Loop over JPG files
-    for path, _, files in os.walk(folder_path):
-        if len(files) > 0:
-            log.info("   *** Optimizing: " + path)
-            for image_name in image_files(files):
-                absolute_filepath = path + os.sep + image_name
-                if not dry_run:
-                    success = optimize_file(absolute_filepath, log)
-                    if not success:
-                        log.info("removing image:", absolute_filepath)
-                        os.remove(absolute_filepath)
-                else:
-                    time.sleep(1/total_images)
-                total_pbar.update()
-            if dirs_pbar:
-                dirs_pbar.update()
+    start = time.perf_counter()
+    totals = {"images": 0, "failed": 0, "skipped": 0, "bytes before": 0, "bytes after": 0}
+    cache = OptimizeCache(optimize_settings(max_width, target_bytes, target_bpp)) \
+        if not dry_run else None
+
+    def lookup(file_path):
+        """returns the skipped OptimizeResult of an unchanged image or None and the known record or None"""
+        if cache is None or reoptimize:
+            return None, None
+        unchanged, known = cache.lookup(file_path)
+        if unchanged and not tag:
+            size = os.path.getsize(get_writer().current(file_path))
+            return OptimizeResult(file_path, True, True, size, size, known), known
+        return None, known
+
+    def add_result(result):
+        totals["images"] += 1
+        totals["bytes before"] += result.size_before
+        totals["bytes after"] += result.size_after
+        if result.skipped:
+            totals["skipped"] += 1
+        if not result.success:
+            totals["failed"] += 1
+            drop_failed_image(result, manifest, log)
+        elif cache is not None:
+            cache.add(result)
+        total_pbar.update()
+
+    try:
+        if jobs > 1 and not dry_run:
+            optimize_folder_parallel(manifest, jobs, lookup, add_result, dirs_pbar, log, max_width,
+                                     tag=tag, target_bytes=target_bytes, target_bpp=target_bpp)
+        else:
+            # Loop over JPG files
+            for path, entries in manifest.image_dirs():
+                if len(entries) > 0:
+                    log.info("   *** Optimizing: " + path)
+                    for entry in entries:
+                        absolute_filepath = entry.path
+                        if not dry_run:
+                            result, known = lookup(absolute_filepath)
+                            if result is None:
+                                result = optimize_entry(absolute_filepath, log, known, max_width,
+                                                        tag, target_bytes, target_bpp)
+                            add_result(result)
+                        else:
+                            time.sleep(1/total_images)
+                            total_pbar.update()
+                    if dirs_pbar:
+                        dirs_pbar.update()
+    finally:
+        if cache is not None:
+            cache.close()
     total_pbar.close()
     if dirs_pbar:
         dirs_pbar.close()
+    seconds = time.perf_counter() - start
+    if not dry_run and totals["images"] > 0:
+        log.info("   *** Optimized " + str(totals["images"] - totals["skipped"]) + " images (" +
+                 str(totals["skipped"]) + " optimized before, " + str(totals["failed"]) +
+                 " failed) in " + "%.1f s, %.1f images/s, %.1f MB/s, %.1f MB -> %.1f MB" % (
+                     seconds, totals["images"] / seconds,
+                     totals["bytes before"] / 1024 / 1024 / seconds,
+                     totals["bytes before"] / 1024 / 1024, totals["bytes after"] / 1024 / 1024))
+    return totals
+
+
+def optimize_folder_parallel(manifest, jobs, lookup, add_result, dirs_pbar, log, max_width=None,
+                             chunk_size=4, tag=False, target_bytes=None, target_bpp=None):
+    remaining_per_dir = {}
+    tasks = []
+    for path, entries in manifest.image_dirs():
+        remaining_per_dir[path] = len(entries)
+        for entry in entries:
+            result, known = lookup(entry.path)
+            if result is not None:
+                add_result(result)
+                remaining_per_dir[path] -= 1
+            else:
+                tasks.append((entry.path, known))
+        if remaining_per_dir[path] == 0 and dirs_pbar:
+            dirs_pbar.update()
+
+    log.info("   *** Optimizing with " + str(jobs) + " processes")
+    worker = functools.partial(optimize_worker, log_level=log.getEffectiveLevel(),
+                               max_width=max_width, tag=tag, target_bytes=target_bytes,
+                               target_bpp=target_bpp)
+    chunks = [tasks[start:start + chunk_size] for start in range(0, len(tasks), chunk_size)]
+    with multiprocessing.Pool(jobs, initializer=init_worker,
+                              initargs=worker_args()) as pool:
+        for results, records in pool.imap_unordered(worker, chunks):
+            replay(log, records)
+            for result in results:
+                # files are only deleted and journaled here, in the parent
+                add_result(result)
+                path = os.path.dirname(result.path)
+                remaining_per_dir[path] -= 1
+                if remaining_per_dir[path] == 0:
+                    log.info("   *** Optimized: " + path)
+                    if dirs_pbar:
+                        dirs_pbar.update()
 
 
 #
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import logging
 import os
 import sys
@@ -10,8 +11,13 @@ from datetime import datetime
 import tqdm
 
 from addmaptags3 import process_image_tags
+from atomicwrite3 import AtomicWriter, set_writer
+from blurfilter3 import filter_blurry
+from exifpil3 import shutdown_exiftool_pool
 from jpegoptimizer3 import optimize_folder
-from tinyuploader3 import upload_folder
+from pipeline3 import process_folder_pipelined
+from scanner3 import scan_folder
+from tinyuploader3 import UploadScheduler, upload_folder
 
 # https://stackoverflow.com/a/38739634/10314791
 
@@ -34,17 +40,67 @@ class TqdmLoggingHandler(logging.Handler):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""Process image tags, optimize images and upload images from IMAGES_PATH as image sequence(s) to mapillary.com.\n
     If you do not process the tags, the images may not get recognized, or get put into one sequence regardless of the folder structure.\n
-    If the optimize flag is set, images may get deleted""", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    If the optimize flag is set, images PIL cannot decode or without EXIF get deleted""", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-d', '--images_path', type=str,
                         default=r"D:\Mapillary\DCIM", help='path to images')
     parser.add_argument(
         '-n', '--dry_run', help='dry run, do not actually change any imagery, instead sleep for a very short while', action="store_true")
     parser.add_argument('-p', '--process_tags',
                         help='do not process the image tags', action="store_false")
+    parser.add_argument('-b', '--batch_tags',
+                        help='read the tags of all images with one exiftool call before processing them', action="store_true")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes used to process the image tags and to optimize the images')
+    parser.add_argument('--fuse_tag_optimize', action="store_true",
+                        help='process the image tags while optimizing, so every image is decoded and written once')
+    parser.add_argument('--max_blur', type=float, default=None,
+                        help='move images with a higher BlurExtent (0: sharp .. 1: blurry) aside before optimizing, no blur filter if not given')
+    parser.add_argument('--blur_cache_path', default=None,
+                        help='file of the blur scores of earlier runs, blurscores3.sqlite next to the scripts if not given')
+    parser.add_argument('--blur_width', type=int, default=None,
+                        help='score the blur of JPEGs decoded at 1/2 .. 1/8 of their size, at least this wide, see benchmark3.py blur_scale')
     parser.add_argument('-o', '--optimize_images',
                         help='do not optimize jpeg images', action="store_false")
+    parser.add_argument('--output', default=None,
+                        help='write the tagged and optimized images to this folder instead of changing them in images_path, and upload them from there')
+    parser.add_argument('--max_width', type=int, default=None,
+                        help='shrink wider images to this width while optimizing, e.g. 2048')
+    parser.add_argument('--target_kb', type=float, default=None,
+                        help='choose the JPEG quality of every image to fit this size in KB instead of using quality 75')
+    parser.add_argument('--target_bpp', type=float, default=None,
+                        help='choose the JPEG quality of every image to fit this many bits per pixel instead of using quality 75')
+    parser.add_argument('--reoptimize', action="store_true",
+                        help='optimize the images again, even those optimized by an earlier run')
     parser.add_argument('-u', '--upload_images',
                         help='do not upload the images', action="store_false")
+    parser.add_argument('--upload_concurrency', type=int, default=1,
+                        help='number of images uploaded at once per session')
+    parser.add_argument('--upload_sessions', type=int, default=1,
+                        help='number of directories uploaded at once')
+    parser.add_argument('--prefetch_sessions', type=int, default=2,
+                        help='number of upcoming directories whose upload session is opened ahead')
+    parser.add_argument('--max_open_sessions', type=int, default=None,
+                        help='maximum number of upload sessions open at once, upload_sessions + prefetch_sessions if not given')
+    parser.add_argument('--no_upload_index', dest='upload_index', action="store_false",
+                        help='upload images even if an image with the same image data was uploaded before under another name')
+    parser.add_argument('--upload_index_path', default=None,
+                        help='file of the index of uploaded images, uploadindex3.sqlite next to the scripts if not given')
+    parser.add_argument('--upload_retries', type=int, default=5,
+                        help='number of retries of a failing upload request')
+    parser.add_argument('--upload_rate', type=float, default=None,
+                        help='maximum upload requests per second, unlimited if not given')
+    parser.add_argument('--upload_bandwidth', type=float, default=None,
+                        help='maximum upload bandwidth in MB/s, unlimited if not given')
+    parser.add_argument('-s', '--pipeline',
+                        help='pass every image through tagging, optimizing and uploading on its own instead of stage by stage', action="store_true")
+    parser.add_argument('--tag_workers', type=int, default=1,
+                        help='number of tagging threads in pipeline mode')
+    parser.add_argument('--optimize_workers', type=int, default=2,
+                        help='number of optimizing threads in pipeline mode')
+    parser.add_argument('--upload_workers', type=int, default=4,
+                        help='number of uploading threads in pipeline mode')
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='number of images waiting between two stages in pipeline mode')
     parser.add_argument('-l', '--log_level',
                         help="""set the wanted logging verbosity, 0: DEBUG, 1: INFO, 2: WARNING, 3: ERROR, 4: FATAL""", default=1, type=int)
 
@@ -54,7 +110,10 @@ if __name__ == "__main__":
     dry_run = args.dry_run
     optimize_images = args.optimize_images
     process_tags = args.process_tags
+    batch_tags = args.batch_tags
+    jobs = args.jobs
     upload_images = args.upload_images
+    pipeline = args.pipeline
     log_level = args.log_level
 
     # set up logging
@@ -84,16 +143,54 @@ if __name__ == "__main__":
     log.debug("images_path " + str(images_path))
     log.debug("dry_run " + str(dry_run))
     log.debug("process_tags " + str(process_tags))
+    log.debug("batch_tags " + str(batch_tags))
+    log.debug("jobs " + str(jobs))
     log.debug("optimize_images " + str(optimize_images))
     log.debug("upload_images " + str(upload_images))
+    log.debug("pipeline " + str(pipeline))
+
+    # stop the exiftool worker processes however we leave
+    atexit.register(shutdown_exiftool_pool)
 
     # for i in tqdm.tqdm(range(100)):
     #     time.sleep(1)
     #     log.info(i)
 
+    scheduler = UploadScheduler(max_retries=args.upload_retries, requests_per_second=args.upload_rate,
+                                bytes_per_second=args.upload_bandwidth * 1024 * 1024 if args.upload_bandwidth else None)
+
+    target_bytes = int(args.target_kb * 1024) if args.target_kb else None
+
+    # every stage rewrites the images through the same atomic writer
+    if args.output:
+        set_writer(AtomicWriter(output_root=args.output, source_root=images_path))
+
+    # scan the images once for all stages
+    manifest = None
+    if os.path.isdir(images_path):
+        manifest = scan_folder(images_path)
+        log.info("found " + str(manifest.total_images) + " images in " +
+                 str(manifest.total_image_dirs) + " directories")
+
     # do the main work
-    if process_tags:
-        success = process_image_tags(images_path, dry_run, log)
+    if pipeline:
+        success = process_folder_pipelined(images_path, dry_run, log, process_tags, optimize_images, upload_images,
+                                           args.tag_workers, args.optimize_workers, args.upload_workers,
+                                           args.queue_size, manifest=manifest, scheduler=scheduler,
+                                           use_index=args.upload_index, index_path=args.upload_index_path,
+                                           reoptimize=args.reoptimize, max_width=args.max_width,
+                                           fuse_tag_optimize=args.fuse_tag_optimize,
+                                           target_bytes=target_bytes, target_bpp=args.target_bpp,
+                                           max_blur=args.max_blur, blur_cache_path=args.blur_cache_path,
+                                           blur_width=args.blur_width)
+        exit(0 if success else 1)
+
+    fused = args.fuse_tag_optimize and process_tags and optimize_images
+    if fused:
+        log.info("processing the image tags while optimizing the images.")
+    elif process_tags:
+        success = process_image_tags(
+            images_path, dry_run, log, batch=batch_tags, jobs=jobs, manifest=manifest)
         if not success:
             log.info("Processing of image tags failed, not continuing!")
             exit(1)
@@ -101,12 +198,26 @@ if __name__ == "__main__":
         log.info(
             "not processing the image tags, as specified by commandline argument.")
 
+    if args.max_blur is not None:
+        filter_blurry(images_path, dry_run, log, args.max_blur, manifest=manifest, jobs=jobs,
+                      cache_path=args.blur_cache_path, analysis_width=args.blur_width)
+
     if optimize_images:
-        optimize_folder(images_path, dry_run, log)
+        optimize_folder(images_path, dry_run, log, manifest=manifest, jobs=jobs,
+                        reoptimize=args.reoptimize, max_width=args.max_width, tag=fused,
+                        target_bytes=target_bytes, target_bpp=args.target_bpp)
     else:
         log.info("not optimizing the images, as specified by commandline argument.")
 
     if upload_images:
-        upload_folder(images_path, dry_run, log)
+        if args.output and os.path.isdir(args.output):
+            # the written images, with the session files next to them
+            images_path = args.output
+            manifest = scan_folder(images_path)
+        upload_folder(images_path, dry_run, log, manifest=manifest,
+                      concurrency=args.upload_concurrency, parallel_sessions=args.upload_sessions,
+                      scheduler=scheduler, prefetch_sessions=args.prefetch_sessions,
+                      max_open_sessions=args.max_open_sessions,
+                      use_index=args.upload_index, index_path=args.upload_index_path)
     else:
         log.info("not uploading the images, as specified by commandline argument.")
@@ -0,0 +1,261 @@
+#
+#   file: pipeline3.py
+#
+#   purpose: move every image through the tag -> optimize -> upload stages on
+#            its own instead of running each stage over the whole folder.
+#            The stages are joined by bounded queues and have their own
+#            number of worker threads, so encoding and uploading overlap and
+#            a directory's session is published as soon as its last image
+#            is through. Images journaled by an earlier run are not sent again.
+#
+
+import os
+import queue
+import threading
+import time
+
+import tqdm
+
+from addmaptags3 import add_mapillary_tags
+from atomicwrite3 import get_writer
+from blurfilter3 import BlurScoreCache, cached_score, set_aside
+from jpegoptimizer3 import OptimizeCache, drop_failed_image, optimize_entry, optimize_settings
+from scanner3 import scan_folder
+from tinyuploader3 import DirectoryUpload, UploadClient, read_access_token
+from uploadindex3 import UploadIndex
+
+
+class Stage:
+    """One step of the pipeline. function(file_path) returns False if the
+    image should not be passed on to the next stage."""
+
+    def __init__(self, name, function, workers):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class Pipeline:
+    """Runs stages in worker threads joined by bounded queues.
+    on_done(file_path) is called once for every image leaving the pipeline,
+    whether it went through all stages or was dropped."""
+
+    def __init__(self, stages, log, queue_size=16, on_done=None):
+        self._stages = stages
+        self._log = log
+        self._queues = [queue.Queue(queue_size) for _ in stages]
+        self._on_done = on_done
+        self._running = [stage.workers for stage in stages]
+        self._lock = threading.Lock()
+        self._pbars = []
+
+    def _finish(self, file_path):
+        if self._on_done:
+            try:
+                self._on_done(file_path)
+            except Exception as error:
+                self._log.error("finishing failed: " + file_path + ": " + repr(error))
+
+    def _work(self, index):
+        stage = self._stages[index]
+        in_queue = self._queues[index]
+        try:
+            while True:
+                file_path = in_queue.get()
+                if file_path is None:
+                    break
+                try:
+                    passed = stage.function(file_path) is not False
+                except Exception as error:
+                    self._log.error(stage.name + " failed: " +
+                                    file_path + ": " + repr(error))
+                    passed = False
+                self._pbars[index].update()
+                if passed and index + 1 < len(self._stages):
+                    self._queues[index + 1].put(file_path)
+                else:
+                    self._finish(file_path)
+        finally:
+            # the last worker of a stage tells the next stage to stop, even if this one died
+            with self._lock:
+                self._running[index] -= 1
+                last = self._running[index] == 0
+            if last and index + 1 < len(self._stages):
+                for _ in range(self._stages[index + 1].workers):
+                    self._queues[index + 1].put(None)
+
+    def run(self, file_paths):
+        self._pbars = [tqdm.tqdm(total=len(file_paths), desc=stage.name, position=i,
+                                 dynamic_ncols=True) for i, stage in enumerate(self._stages)]
+        threads = []
+        for index, stage in enumerate(self._stages):
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,),
+                                          name=stage.name, daemon=True)
+                thread.start()
+                threads.append(thread)
+        for file_path in file_paths:
+            self._queues[0].put(file_path)
+        for _ in range(self._stages[0].workers):
+            self._queues[0].put(None)
+        for thread in threads:
+            thread.join()
+        for pbar in self._pbars:
+            pbar.close()
+
+
+class DirectorySessions:
+    """Keeps one tinyuploader3.DirectoryUpload per directory and finishes,
+    i.e. publishes, it when the last image of the directory left the pipeline.
+    The session files go where the atomicwrite3.AtomicWriter writes the images."""
+
+    def __init__(self, remaining_per_dir, client, dry_run, log, index=None):
+        self._remaining = remaining_per_dir
+        self._index = index
+        self._client = client
+        self._dry_run = dry_run
+        self._log = log
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            if path not in self._uploads:
+                self._log.info("   *** Uploading directory: " + path)
+                destination = get_writer().destination(path)
+                if not self._dry_run:
+                    # an output tree has no copy of a directory no stage wrote to
+                    os.makedirs(destination, exist_ok=True)
+                self._uploads[path] = DirectoryUpload(
+                    self._client, destination, self._dry_run, self._log, self._index)
+            return self._uploads[path]
+
+    def done(self, file_path):
+        path = os.path.dirname(file_path)
+        with self._lock:
+            self._remaining[path] -= 1
+            if self._remaining[path] > 0 or path not in self._uploads:
+                return
+            upload = self._uploads.pop(path)
+        upload.retry_failed()
+        upload.finish()
+
+
+def process_folder_pipelined(folder_path, dry_run, log, process_tags=True, optimize_images=True,
+                             upload_images=True, tag_workers=1, optimize_workers=2,
+                             upload_workers=4, queue_size=16, manifest=None, scheduler=None,
+                             use_index=True, index_path=None, reoptimize=False, max_width=None,
+                             fuse_tag_optimize=False, target_bytes=None, target_bpp=None,
+                             max_blur=None, blur_cache_path=None, blur_width=None):
+    """tags, optimizes and uploads the images of folder_path image by image
+       manifest is the scanner3.Manifest of folder_path, it is scanned if not given
+       scheduler is the tinyuploader3.UploadScheduler for retries and rate limits
+       use_index and index_path select the uploadindex3.UploadIndex as in upload_folder,
+       an upload worker hashes its image while the other workers transfer theirs
+       images optimized by an earlier run are not optimized again, unless reoptimize is set,
+       images wider than max_width are shrunk to it
+       with fuse_tag_optimize, tagging and optimizing is one stage writing every image once
+       target_bytes or target_bpp set a size budget per image as in jpegoptimizer3.optimize_file
+       with max_blur set, images blurrier than that, scored at blur_width if given, are set aside
+       as in blurfilter3.filter_blurry
+       returns success
+    """
+    if dry_run:
+        log.warning(
+            "*** DRY RUN, NOT ACTUALLY CHANGING OR UPLOADING ANY IMAGERY, THE FOLLOWING IS SAMPLE OUTPUT")
+    log.info("   *** Pipelined processing ***")
+    if not(os.path.isdir(folder_path)):
+        log.warning("No valid directory given as parameter.")
+        return False
+
+    if manifest is None:
+        manifest = scan_folder(folder_path)
+    file_paths = []
+    remaining_per_dir = {}
+    for path, entries in manifest.image_dirs():
+        remaining_per_dir[path] = len(entries)
+        file_paths += [entry.path for entry in entries]
+
+    def tag(file_path):
+        if dry_run:
+            time.sleep(0.01)
+            return True
+        return add_mapillary_tags(file_path, log)
+
+    blur_cache = BlurScoreCache(blur_cache_path, blur_width) if max_blur is not None else None
+
+    def blur(file_path):
+        if dry_run:
+            time.sleep(0.01)
+            return True
+        if cached_score(file_path, blur_cache) > max_blur:
+            set_aside(folder_path, file_path, manifest, log)
+            return False
+        return True
+
+    cache = OptimizeCache(optimize_settings(max_width, target_bytes, target_bpp)) \
+        if optimize_images and not dry_run else None
+    fused = fuse_tag_optimize and process_tags and optimize_images
+
+    def optimize(file_path):
+        if dry_run:
+            time.sleep(0.01)
+            return True
+        unchanged, known = cache.lookup(file_path) if cache and not reoptimize else (False, None)
+        if unchanged and not fused:
+            return True
+        result = optimize_entry(file_path, log, known, max_width, fused, target_bytes, target_bpp)
+        if not result.success:
+            drop_failed_image(result, manifest, log)
+        elif cache:
+            cache.add(result)
+        return result.success
+
+    sessions = None
+    index = None
+    if upload_images:
+        client = UploadClient(read_access_token(log), pool_size=upload_workers + 1,
+                              scheduler=scheduler, log=log)
+        if use_index:
+            index = UploadIndex(index_path)
+        sessions = DirectorySessions(remaining_per_dir, client, dry_run, log, index)
+
+    def upload(file_path):
+        sessions.get(os.path.dirname(file_path)).upload(get_writer().current(file_path))
+        return True
+
+    stages = []
+    if fused:
+        if max_blur is not None:
+            # blurry images should not cost an encode
+            stages.append(Stage("blur", blur, optimize_workers))
+        stages.append(Stage("tag+optimize", optimize, optimize_workers))
+    else:
+        if process_tags:
+            stages.append(Stage("tag", tag, tag_workers))
+        if max_blur is not None:
+            stages.append(Stage("blur", blur, optimize_workers))
+        if optimize_images:
+            stages.append(Stage("optimize", optimize, optimize_workers))
+    if upload_images:
+        stages.append(Stage("upload", upload, upload_workers))
+    if len(stages) == 0:
+        log.info("no stage to run, as specified by commandline argument.")
+        return True
+
+    pipeline = Pipeline(stages, log, queue_size,
+                        on_done=sessions.done if sessions else None)
+    try:
+        pipeline.run(file_paths)
+    finally:
+        if cache:
+            cache.close()
+        if blur_cache:
+            blur_cache.close()
+        get_writer().sync()
+    if upload_images:
+        log.info("   *** Connections: " + str(client.connection_stats()))
+        client.close()
+        if index is not None:
+            index.close()
+    return True
@@ -1,8 +1,34 @@
 import os
 import sys
+from collections import namedtuple
 from tqdm import tqdm
 from math import asin, cos, radians, sin, sqrt
-from exifpil3 import PILExifReader
+import numpy
+import gpsarrays3
+from exifpil3 import ExifException, PILExifReader
+
+
+# what the finders need of an image, read once per file by read_image_record()
+ImageRecord = namedtuple("ImageRecord", "file_path capture_time lat lon speed direction gps_time")
+
+
+def read_image_record(file_path):
+    """Reads the EXIF of file_path once and returns its ImageRecord,
+  with None for every value that is missing."""
+    exif_reader = PILExifReader(file_path)
+    lat_lon = exif_reader.get_lat_lon()
+    try:
+        gps_time = exif_reader.get_time()
+    except ExifException as e:
+        print("Invalid GPS time in " + file_path + ": " + str(e))
+        gps_time = None
+    return ImageRecord(file_path=file_path,
+                       capture_time=exif_reader.read_capture_time(),
+                       lat=lat_lon[0] if lat_lon is not None else None,
+                       lon=lat_lon[1] if lat_lon is not None else None,
+                       speed=exif_reader.get_speed(),
+                       direction=exif_reader.get_rotation(),
+                       gps_time=gps_time)
 
 
 class GPSDirectionDuplicateFinder:
@@ -22,8 +48,8 @@ class GPSDirectionDuplicateFinder:
         if not is_duplicate:
             self._prev_unique_rotation = self._prev_rotation
 
-    def is_duplicate(self, file_path, exif_reader):
-        # rotation = exif_reader.get_rotation()
+    def is_duplicate(self, record):
+        # rotation = record.direction
         #
         # if rotation is None:
         #     return None
@@ -63,17 +89,45 @@ class GPSDistance:
         # It is not a perfect sphere, so this is just good enough.
         return c * r
 
+    @staticmethod
+    def get_ecef(lat, lon):
+        """
+    Earth centered x, y, z in meters of a point on the same sphere as
+    get_gps_distance. Over a few meters the straight distance between
+    two of them is the great circle distance.
+    """
+        lat, lon = radians(lat), radians(lon)
+        r = 6371000
+        return (r * cos(lat) * cos(lon), r * cos(lat) * sin(lon), r * sin(lat))
+
+
+class ErrorFinder:
+    """What ImageRemover asks of an error finder. prepare() gets the
+  ImageRecords of all images in time order, before is_error() is
+  asked about each of them in that order."""
+
+    _latest_text = ""
+
+    def get_latest_text(self):
+        return self._latest_text
+
+    def prepare(self, records):
+        pass
+
+    def is_error(self, record):
+        raise NotImplementedError
 
-class GPSSpeedErrorFinder:
+
+class GPSSpeedErrorFinder(ErrorFinder):
     """Finds images in a sequence that might have an error in GPS data
      or suggest a track to be split. It is done by looking at the
-     speed it would take to travel the distance in question."""
+     speed it would take to travel the distance in question.
+     prepare() checks the whole sequence at once, is_error() then
+     answers per image."""
 
     def __init__(self, max_speed_km_h, way_too_high_speed_km_h):
-        self._prev_lat_lon = None
-        self._previous = None
+        self._errors = {}
         self._latest_text = ""
-        self._previous_filepath = None
         self._max_speed_km_h = max_speed_km_h
         self._way_too_high_speed_km_h = way_too_high_speed_km_h
         self._high_speed = False
@@ -82,59 +136,89 @@ class GPSSpeedErrorFinder:
     def set_verbose(self, verbose):
         self.verbose = verbose
 
-    def get_latest_text(self):
-        return self._latest_text
-
-    def is_error(self, file_path, exif_reader):
+    def prepare(self, records):
         """
-    Returns if there is an obvious error in the images exif data.
-    The given image is an instance of PIL's Image class.
-    the given exif is the data from the get_exif_data function.
+    Checks the ImageRecords of a sequence in time order. An image is an
+    error if its GPS speed is too high, or if the speed from the last
+    image with a GPS speed, position and time that is no error is. Images
+    without a GPS speed are not checked.
     """
-        speed_gps = exif_reader.get_speed()
-        if speed_gps is None:
-            self._latest_text = "No speed given in EXIF data."
-            return False
-        self._latest_text = "Speed GPS: " + str(speed_gps) + " km/h"
-        if speed_gps > self._way_too_high_speed_km_h:
-            self._latest_text = ("GPS speed is unrealistically high: %s km/h."
-                                 % speed_gps)
+        self._errors = {}
+        if not records:
+            return
+        speed_gps = numpy.array([numpy.nan if r.speed is None else r.speed
+                                 for r in records], dtype=float)
+        for i in numpy.flatnonzero(speed_gps > self._way_too_high_speed_km_h):
+            self._errors[records[i].file_path] = (
+                "GPS speed is unrealistically high: %s km/h." % records[i].speed)
             self._too_high_speed = True
-            return True
-        elif speed_gps > self._max_speed_km_h:
-            self._latest_text = ("GPS speed is high: %s km/h."
-                                 % speed_gps)
+        for i in numpy.flatnonzero((speed_gps > self._max_speed_km_h) &
+                                   (speed_gps <= self._way_too_high_speed_km_h)):
+            self._errors[records[i].file_path] = (
+                "GPS speed is high: %s km/h." % records[i].speed)
             self._high_speed = True
-            return True
-        latlong = exif_reader.get_lat_lon()
-        timestamp = exif_reader.get_time()
-        if self._prev_lat_lon is None or self._prev_time is None:
-            self._prev_lat_lon = latlong
-            self._prev_time = timestamp
-            self._previous_filepath = file_path
-            return False
-        if latlong is None or timestamp is None:
-            return False
-        diff_meters = GPSDistance.get_gps_distance(
-            self._prev_lat_lon[0], self._prev_lat_lon[1], latlong[0],
-            latlong[1])
-        diff_secs = (timestamp - self._prev_time).total_seconds()
-        if diff_secs == 0:
-            return False
-        speed_km_h = (diff_meters / diff_secs) * 3.6
+
+        # the images that passed the check above, with position and time
+        track = [i for i, r in enumerate(records)
+                 if speed_gps[i] <= self._max_speed_km_h and r.lat is not None
+                 and r.gps_time is not None]
+        if len(track) < 2:
+            return
+        lat = numpy.array([records[i].lat for i in track])
+        lon = numpy.array([records[i].lon for i in track])
+        secs = numpy.concatenate(([0.0], numpy.cumsum(
+            gpsarrays3.time_deltas([records[i].gps_time for i in track]))))
+
+        def speed_between(j, k):
+            return gpsarrays3.implied_speed(
+                gpsarrays3.haversine_distance(lat[j], lon[j], lat[k], lon[k]), secs[k] - secs[j])
+
+        # the speeds between consecutive images at once, only after an error the
+        # speeds from the last image that is no error are computed one by one
+        step_speed = gpsarrays3.implied_speed(
+            gpsarrays3.haversine_distance(lat[:-1], lon[:-1], lat[1:], lon[1:]), numpy.diff(secs))
+        candidates = (numpy.flatnonzero(step_speed > self._max_speed_km_h) + 1).tolist()
+        c = 0
+        while c < len(candidates):
+            # all images before the candidate k passed, as they were no candidates
+            previous = candidates[c] - 1
+            k = candidates[c]
+            speed_km_h = step_speed[k - 1]
+            while speed_km_h > self._max_speed_km_h:
+                self._add_speed_error(records[track[previous]].file_path,
+                                      records[track[k]].file_path, speed_km_h)
+                k += 1
+                if k == len(track):
+                    break
+                speed_km_h = speed_between(previous, k)
+            # k is no error, the candidates up to it are decided
+            while c < len(candidates) and candidates[c] <= k:
+                c += 1
+
+    def _add_speed_error(self, previous_filepath, file_path, speed_km_h):
         if speed_km_h > self._way_too_high_speed_km_h:
-            self._latest_text = ("Speed between %s and %s is %s km/h, which is"
-                                 " unrealistically high." % (self._previous_filepath, file_path, int(speed_km_h)))
+            self._errors[file_path] = (
+                "Speed between %s and %s is %s km/h, which is unrealistically high."
+                % (previous_filepath, file_path, int(speed_km_h)))
             self._too_high_speed = True
-            return True
-        elif speed_km_h > self._max_speed_km_h:
-            self._latest_text = "Speed between %s and %s is %s km/h." % (
-                self._previous_filepath, file_path, int(speed_km_h)
-            )
+        else:
+            self._errors[file_path] = "Speed between %s and %s is %s km/h." % (
+                previous_filepath, file_path, int(speed_km_h))
             self._high_speed = True
+
+    def is_error(self, record):
+        """
+    Returns if there is an obvious error in the exif data of the
+    image of the given ImageRecord, after prepare() got its sequence.
+    """
+        if record.file_path in self._errors:
+            self._latest_text = self._errors[record.file_path]
             return True
+        if record.speed is None:
+            self._latest_text = "No speed given in EXIF data."
         else:
-            return False
+            self._latest_text = "Speed GPS: " + str(record.speed) + " km/h"
+        return False
 
     def is_fast(self):
         return self._high_speed
@@ -162,13 +246,13 @@ class GPSDistanceDuplicateFinder:
         if not is_duplicate:
             self._prev_unique_lat_lon = self._prev_lat_lon
 
-    def is_duplicate(self, file_path, exif_reader):
+    def is_duplicate(self, record):
         """
-    Returns if the given image is a duplicate of the previous image.
-    The given image is an instance of PIL's Image class.
-    the given exif is the data from the get_exif_data function.
+    Returns if the image of the given ImageRecord is a duplicate
+    of the previous image.
     """
-        latlong = exif_reader.get_lat_lon()
+        file_path = record.file_path
+        latlong = (record.lat, record.lon) if record.lat is not None else None
 
         if self._prev_lat_lon is None:
             self._prev_lat_lon = latlong
@@ -188,6 +272,69 @@ class GPSDistanceDuplicateFinder:
             return False
 
 
+class GPSSpatialDuplicateFinder:
+    """Finds duplicate images by looking for any kept image within a
+  distance and heading, not just the previous one, so a street driven
+  twice is caught on the second pass. The kept images are put into a
+  grid of cubes of the distance over their earth centered coordinates,
+  so only the 27 cubes around an image need to be searched."""
+
+    def __init__(self, distance, max_heading_diff):
+        self._distance = distance
+        self._max_heading_diff = max_heading_diff
+        self._grid = {}
+        self._latest = None
+        self._latest_text = ""
+
+    def get_latest_text(self):
+        return self._latest_text
+
+    def _cell(self, point):
+        return tuple(int(c // self._distance) for c in point)
+
+    def _heading_diff(self, direction, other):
+        if direction is None or other is None:
+            # without a heading the distance decides
+            return 0
+        diff = abs(direction - other) % 360
+        return min(diff, 360 - diff)
+
+    def latest_is_duplicate(self, is_duplicate):
+        if not is_duplicate and self._latest is not None:
+            point, direction, file_path = self._latest
+            self._grid.setdefault(self._cell(point), []).append(
+                (point, direction, file_path))
+        self._latest = None
+
+    def is_duplicate(self, record):
+        """
+    Returns if the image of the given ImageRecord is a duplicate
+    of any image kept so far.
+    """
+        if record.lat is None:
+            self._latest_text = record.file_path + ": no position"
+            return False
+        point = GPSDistance.get_ecef(record.lat, record.lon)
+        self._latest = (point, record.direction, record.file_path)
+        x, y, z = self._cell(point)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for kept_point, kept_direction, kept_file_path in \
+                            self._grid.get((x + dx, y + dy, z + dz), ()):
+                        diff_meters = sqrt(sum((a - b) ** 2 for a, b in zip(point, kept_point)))
+                        if diff_meters > self._distance:
+                            continue
+                        heading_diff = self._heading_diff(record.direction, kept_direction)
+                        if heading_diff > self._max_heading_diff:
+                            continue
+                        self._latest_text = "%s: %d m, %d deg from %s: True" % (
+                            record.file_path, diff_meters, heading_diff, kept_file_path)
+                        return True
+        self._latest_text = record.file_path + ": False"
+        return False
+
+
 class ImageRemover:
     """Moves images that are (almost) duplicates or contains errors in GPS
   data into separate directories."""
@@ -209,6 +356,7 @@ class ImageRemover:
         self._testers.append(tester)
 
     def add_error_finder(self, finder):
+        """finder is an ErrorFinder"""
         self._error_finders.append(finder)
 
     def _move_into_error_dir(self, file):
@@ -223,19 +371,15 @@ class ImageRemover:
                 print("Delete:", file)
             os.remove(file)
 
-    def _read_capture_time(self, filepath):
-        reader = PILExifReader(filepath)
-        return reader.read_capture_time()
-
-    def _sort_file_list(self, file_list):
+    def _read_sorted_records(self, file_list):
         '''
-        Read capture times and sort files in time order.
+        Read the ImageRecord of every file and sort them in time order.
         '''
-        capture_times = [self._read_capture_time(
-            filepath) for filepath in file_list]
-        sorted_times_files = list(zip(capture_times, file_list))
-        sorted_times_files.sort()
-        return list(zip(*sorted_times_files))
+        print("Read", len(file_list), "files.")
+        records = [read_image_record(filepath)
+                   for filepath in tqdm(file_list, dynamic_ncols=True)]
+        records.sort(key=lambda record: (record.capture_time, record.file_path))
+        return records
 
     def do_magic(self):
         """Perform the task of finding and moving images."""
@@ -250,19 +394,20 @@ class ImageRemover:
                 if file_path.lower().endswith('.jpg'):
                     # print(file_path)
                     files.append(file_path)
-        capturetime, files = self._sort_file_list(files)
-        print("Check", len(files), "files.")
-        for file_path in tqdm(files, dynamic_ncols=True):
-            exif_reader = PILExifReader(file_path)
-            is_error = self._handle_possible_erro(file_path, exif_reader)
+        records = self._read_sorted_records(files)
+        for finder in self._error_finders:
+            finder.prepare(records)
+        print("Check", len(records), "files.")
+        for record in tqdm(records, dynamic_ncols=True):
+            is_error = self._handle_possible_erro(record)
             if not is_error:
-                self._handle_possible_duplicate(file_path, exif_reader)
+                self._handle_possible_duplicate(record)
 
-    def _handle_possible_duplicate(self, file_path, exif_reader):
+    def _handle_possible_duplicate(self, record):
         is_duplicate = True
         verbose_text = []
         for tester in self._testers:
-            is_this_duplicate = tester.is_duplicate(file_path, exif_reader)
+            is_this_duplicate = tester.is_duplicate(record)
             if is_this_duplicate != None:
                 is_duplicate &= is_this_duplicate
                 verbose_text.append(tester.get_latest_text())
@@ -272,20 +417,20 @@ class ImageRemover:
         if self.verbose >= 1:
             print(", ".join(verbose_text), "=>", is_duplicate)
         if is_duplicate:
-            self._move_into_duplicate_dir(file_path)
+            self._move_into_duplicate_dir(record.file_path)
         for tester in self._testers:
             tester.latest_is_duplicate(is_duplicate)
         return is_duplicate
 
-    def _handle_possible_erro(self, file_path, exif_reader):
+    def _handle_possible_erro(self, record):
         is_error = False
         for finder in self._error_finders:
-            err = finder.is_error(file_path, exif_reader)
+            err = finder.is_error(record)
             if err:
                 print(finder.get_latest_text())
             is_error |= err
         if is_error:
-            self._move_into_error_dir(file_path)
+            self._move_into_error_dir(record.file_path)
         return is_error
 
 
@@ -297,12 +442,17 @@ if __name__ == "__main__":
     min_duplicates = 3
     dryrun = False
     verbose = 0
+    # set to compare with every kept image, not just the previous one
+    whole_capture = False
     print("*** Dupe remover ***")
     src_dir = sys.argv[1]
     if not(os.path.isdir(src_dir)):
         print("No valid directory given as parameter.")
         exit(1)
-    distance_finder = GPSDistanceDuplicateFinder(distance)
+    if whole_capture:
+        distance_finder = GPSSpatialDuplicateFinder(distance, pan)
+    else:
+        distance_finder = GPSDistanceDuplicateFinder(distance)
     image_remover = ImageRemover(src_dir)
     image_remover.add_duplicate_finder(distance_finder)
     image_remover.do_magic()
@@ -0,0 +1,82 @@
+#
+#   file: scanner3.py
+#
+#   purpose: walk an image folder once with os.scandir and keep the JPEGs
+#            found with their size and mtime in a manifest, which the
+#            tagging, optimizing and uploading stages share instead of
+#            walking the tree again for their counts and their work.
+#
+
+import collections
+import os
+import threading
+
+ManifestEntry = collections.namedtuple(
+    "ManifestEntry", ["path", "name", "size", "mtime"])
+
+
+def is_image_file(name):
+    return name.lower().endswith('.jpg') or name.lower().endswith('.jpeg')
+
+
+class Manifest:
+    """JPEG files below a folder, grouped by directory.
+    Every directory found is a key of dirs, also those without images."""
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.dirs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total_images(self):
+        return sum(len(entries) for entries in self.dirs.values())
+
+    @property
+    def total_image_dirs(self):
+        return len([entries for entries in self.dirs.values() if entries])
+
+    @property
+    def total_bytes(self):
+        return sum(entry.size for entries in self.dirs.values() for entry in entries)
+
+    def image_dirs(self):
+        """Returns (directory, entries) for every directory with images, sorted by path"""
+        with self._lock:
+            return [(path, list(entries)) for path, entries in sorted(self.dirs.items()) if entries]
+
+    def entries(self):
+        return [entry for _, entries in self.image_dirs() for entry in entries]
+
+    def remove(self, file_path):
+        """Forgets a file, e.g. after a stage deleted it"""
+        with self._lock:
+            entries = self.dirs.get(os.path.dirname(file_path), [])
+            for entry in entries:
+                if entry.path == file_path:
+                    entries.remove(entry)
+                    break
+
+
+def scan_folder(folder_path):
+    """Returns the Manifest of folder_path, symlinked directories are not followed like in os.walk"""
+    manifest = Manifest(folder_path)
+    pending = [folder_path]
+    while pending:
+        path = pending.pop()
+        entries = []
+        try:
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        pending.append(dir_entry.path)
+                    elif is_image_file(dir_entry.name) and dir_entry.is_file():
+                        stat = dir_entry.stat()
+                        entries.append(ManifestEntry(dir_entry.path, dir_entry.name,
+                                                     stat.st_size, stat.st_mtime))
+        except OSError:
+            # like os.walk, unreadable directories are skipped
+            continue
+        entries.sort(key=lambda entry: entry.name)
+        manifest.dirs[path] = entries
+    return manifest
@@ -19,7 +19,9 @@ import sys
 import datetime
 import math
 import exifread
+import numpy
 import tqdm
+import gpsarrays3
 
 
 cutoff_time = 60
@@ -467,26 +469,26 @@ class Sequence(object):
         if len(file_list) >= 1:
             # sort based on EXIF capture time
             capture_times, file_list = self.sort_file_list(file_list)
-            # diff in capture time
-            capture_deltas = [t2-t1 for t1,
-                              t2 in zip(capture_times, capture_times[1:])]
+            # diff in capture time in seconds
+            capture_deltas = gpsarrays3.time_deltas(capture_times)
             # read gps for ordered files
-            latlons = [self._read_lat_lon(filepath) for filepath in file_list]
+            latlons = numpy.array([self._read_lat_lon(filepath) for filepath in file_list],
+                                  dtype=float).reshape(-1, 2)
             # distance between consecutive images
-            distances = [gps_distance(ll1, ll2)
-                         for ll1, ll2 in zip(latlons, latlons[1:])]
+            distances = gpsarrays3.step_distances(latlons[:, 0], latlons[:, 1])
             # if cutoff time is given use that, else assume cutoff is 1.5x median time delta
-            if cutoff_time is None:
-                median = sorted(capture_deltas)[len(capture_deltas)//2]
-                # if type(median) is not  int:
-                #     median = median.total_seconds()
+            if cutoff_time is None and len(capture_deltas):
+                median = numpy.sort(capture_deltas)[len(capture_deltas)//2]
                 cutoff_time = 1.5*median
+            cuts_time = capture_deltas > cutoff_time if cutoff_time is not None \
+                else numpy.zeros(len(distances), dtype=bool)
+            cuts_distance = distances > cutoff_distance
             # extract groups by cutting using cutoff time
             group = [file_list[0]]
             cut = 0
             for i, filepath in enumerate(file_list[1:]):
-                cut_time = capture_deltas[i].total_seconds() > cutoff_time
-                cut_distance = distances[i] > cutoff_distance
+                cut_time = cuts_time[i]
+                cut_distance = cuts_distance[i]
                 cut_sequence_length = len(group) > max_sequence_length
                 if cut_time or cut_distance or cut_sequence_length:
                     cut += 1
@@ -498,7 +500,7 @@ class Sequence(object):
                             cut, distances[i], file_list[i+1]))
                     elif cut_time:
                         print('Cut {}: Delta in time {} seconds is too big at {}'.format(
-                            cut, capture_deltas[i].total_seconds(), file_list[i+1]))
+                            cut, capture_deltas[i], file_list[i+1]))
                     elif cut_sequence_length:
                         print('Cut {}: Maximum sequence length {} reached at {}'.format(
                             cut, max_sequence_length, file_list[i+1]))
@@ -545,26 +547,30 @@ class Sequence(object):
         # ordered list by time
         capture_times, file_list = self.sort_file_list(file_list)
         # read gps for ordered files
-        latlons = [self._read_lat_lon(filepath) for filepath in file_list]
+        latlons = numpy.array([self._read_lat_lon(filepath) for filepath in file_list],
+                              dtype=float).reshape(-1, 2)
         # read bearing for ordered files
         bearings = [self._read_direction(filepath) for filepath in file_list]
         # interploated bearings
-        interpolated_bearings = [compute_bearing(ll1[0], ll1[1], ll2[0], ll2[1])
-                                 for ll1, ll2 in zip(latlons, latlons[1:])]
+        interpolated_bearings = gpsarrays3.step_bearings(
+            latlons[:, 0], latlons[:, 1]).tolist()
         interpolated_bearings.append(bearings[-1])
+        # the positions as x, y, z once, the loop below only subtracts them
+        points = numpy.column_stack(gpsarrays3.ecef_from_lla(
+            latlons[:, 0], latlons[:, 1])).tolist()
         # use interploated bearings if bearing not available in EXIF
         for i, b in enumerate(bearings):
             bearings[i] = b if b is not None else interpolated_bearings[i]
 
         is_duplicate = False
         prev_unique = file_list[0]
-        prev_latlon = latlons[0]
+        prev_point = points[0]
         prev_bearing = bearings[0]
         groups = []
         group = []
         for i, filename in enumerate(file_list[1:]):
             k = i+1
-            distance = gps_distance(latlons[k], prev_latlon)
+            distance = math.dist(points[k], prev_point)
             if bearings[k] is not None and prev_bearing is not None:
                 bearing_diff = diff_bearing(bearings[k], prev_bearing)
             else:
@@ -573,7 +579,7 @@ class Sequence(object):
             if distance < min_distance and bearing_diff < min_angle:
                 is_duplicate = True
             else:
-                prev_latlon = latlons[k]
+                prev_point = points[k]
                 prev_bearing = bearings[k]
             if is_duplicate:
                 group.append(filename)
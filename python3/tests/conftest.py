@@ -0,0 +1,55 @@
+#
+#   file: conftest.py
+#
+#   purpose: the scripts import each other as flat modules, as when started
+#            from python3/, so the tests do the same. Every test starts with
+#            a fresh in-place atomicwrite3.AtomicWriter.
+#
+
+import logging
+import os
+import sys
+
+import piexif
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from atomicwrite3 import AtomicWriter, set_writer  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def writer():
+    writer = AtomicWriter()
+    set_writer(writer)
+    yield writer
+    set_writer(AtomicWriter())
+
+
+@pytest.fixture
+def log():
+    return logging.getLogger("tests")
+
+
+def write_jpeg(file_path, width=64, height=48, exif=True, description=None):
+    """a small JPEG with a capture time and a position in its EXIF, unless exif is False"""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    if not exif:
+        image.save(file_path, quality=95)
+        return file_path
+    exif_dict = {
+        "0th": {piexif.ImageIFD.Make: b"Garmin"},
+        "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2019:05:17 09:14:09"},
+        "GPS": {
+            piexif.GPSIFD.GPSLatitudeRef: b"N",
+            piexif.GPSIFD.GPSLatitude: ((52, 1), (30, 1), (0, 1)),
+            piexif.GPSIFD.GPSLongitudeRef: b"E",
+            piexif.GPSIFD.GPSLongitude: ((13, 1), (24, 1), (0, 1)),
+        },
+    }
+    if description is not None:
+        exif_dict["0th"][piexif.ImageIFD.ImageDescription] = description
+    image.save(file_path, quality=95, exif=piexif.dump(exif_dict))
+    return file_path
@@ -0,0 +1,24 @@
+import logging
+import os
+
+import addmaptags3
+from conftest import write_jpeg
+
+
+def test_serial_tagging_continues_after_failure(tmp_path, log, monkeypatch, caplog):
+    folder_path = str(tmp_path / "images")
+    for i in range(3):
+        write_jpeg(os.path.join(folder_path, "a", "%d.jpg" % i))
+    tagged = []
+
+    def add_mapillary_tags(file_path, log):
+        if file_path.endswith("0.jpg"):
+            raise ValueError("broken tags")
+        tagged.append(os.path.basename(file_path))
+
+    monkeypatch.setattr(addmaptags3, "add_mapillary_tags", add_mapillary_tags)
+    with caplog.at_level(logging.INFO):
+        assert addmaptags3.process_image_tags(folder_path, False, log, jobs=1)
+
+    assert sorted(tagged) == ["1.jpg", "2.jpg"]
+    assert "Tagging failed for 1 images" in caplog.text
@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+
+import pipeline3
+import tinyuploader3
+from atomicwrite3 import AtomicWriter, set_writer
+from conftest import write_jpeg
+from jpegoptimizer3 import optimize_folder
+from uploadserver3 import UploadServer
+
+
+def read_tree(folder_path):
+    files = {}
+    for path, _, names in os.walk(folder_path):
+        for name in names:
+            with open(os.path.join(path, name), "rb") as f:
+                files[os.path.relpath(os.path.join(path, name), folder_path)] = f.read()
+    return files
+
+
+def test_spawned_workers_write_to_the_output_tree(tmp_path, log, monkeypatch):
+    source = str(tmp_path / "source")
+    output = str(tmp_path / "output")
+    for i in range(4):
+        write_jpeg(os.path.join(source, "a", "%d.jpg" % i))
+    before = read_tree(source)
+    set_writer(AtomicWriter(output_root=output, source_root=source))
+    # workers that do not inherit the writer, as on Windows
+    monkeypatch.setattr(multiprocessing, "Pool", multiprocessing.get_context("spawn").Pool)
+
+    totals = optimize_folder(source, False, log, jobs=2)
+
+    assert totals["failed"] == 0
+    assert read_tree(source) == before
+    assert sorted(read_tree(os.path.join(output, "a"))) == \
+        ["0.jpg", "1.jpg", "2.jpg", "3.jpg", "optimized.journal"]
+
+
+def test_upload_of_directory_without_written_copy(tmp_path, log, monkeypatch):
+    source = str(tmp_path / "source")
+    output = str(tmp_path / "output")
+    write_jpeg(os.path.join(source, "a", "0.jpg"))
+    before = read_tree(source)
+    set_writer(AtomicWriter(output_root=output, source_root=source))
+    server = UploadServer().start()
+    monkeypatch.setattr(tinyuploader3, "api_url", server.api_url)
+    monkeypatch.setattr(pipeline3, "read_access_token", lambda log: "test")
+    try:
+        success = pipeline3.process_folder_pipelined(source, False, log, process_tags=False,
+                                                     optimize_images=False, use_index=False)
+    finally:
+        server.shutdown()
+
+    assert success
+    assert read_tree(source) == before
+    assert "session.journal" in os.listdir(os.path.join(output, "a"))
+
+
+def test_replace_completes_where_directories_cannot_be_opened(tmp_path, monkeypatch):
+    file_path = str(tmp_path / "a.bin")
+    open_file = os.open
+
+    def open_no_directory(path, flags, *args, **kwargs):
+        if os.path.isdir(path):
+            raise PermissionError(13, "Permission denied", path)
+        return open_file(path, flags, *args, **kwargs)
+
+    # as on Windows, where a directory cannot be opened to fsync it
+    monkeypatch.setattr(os, "open", open_no_directory)
+    writer = AtomicWriter(dir_sync_batch=1)
+    with writer.replace(file_path) as f:
+        f.write(b"data")
+
+    with open(file_path, "rb") as f:
+        assert f.read() == b"data"
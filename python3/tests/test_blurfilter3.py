@@ -0,0 +1,15 @@
+import sqlite3
+
+from blurfilter3 import BlurScoreCache
+
+
+def test_scores_are_committed_every_batch(tmp_path):
+    path = str(tmp_path / "blurscores3.sqlite")
+    cache = BlurScoreCache(path, batch_size=4)
+    for i in range(6):
+        cache.add("hash%d" % i, i / 10)
+
+    # what a crash before close() would leave
+    committed = sqlite3.connect(path).execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+    cache.close()
+    assert committed == 4
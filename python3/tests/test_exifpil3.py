@@ -0,0 +1,72 @@
+import os
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from exifpil3 import ExifException, ExifToolPool
+
+FAKE_EXIFTOOL = """\
+    #!{python}
+    # answers every -executeN of exiftool -stay_open, dies on the argument "die"
+    import sys
+    import time
+    args = []
+    for line in sys.stdin:
+        line = line.strip()
+        if line.startswith("-execute"):
+            if "die" in args:
+                time.sleep(0.5)
+                sys.exit(1)
+            print(" ".join(args))
+            print("{{ready" + line[len("-execute"):] + "}}", flush=True)
+            args = []
+        else:
+            args.append(line)
+"""
+
+
+@pytest.fixture
+def exiftool(tmp_path):
+    path = str(tmp_path / "exiftool")
+    with open(path, "w") as f:
+        f.write(textwrap.dedent(FAKE_EXIFTOOL).format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+
+def call(pool, args, results):
+    try:
+        results.append(pool.execute(*args))
+    except ExifException as error:
+        results.append(error)
+
+
+def test_waiting_caller_gets_new_worker_when_one_dies(exiftool):
+    pool = ExifToolPool(1, exiftool)
+    dying = []
+    waiting = []
+    threading.Thread(target=call, args=(pool, ["die"], dying)).start()
+    time.sleep(0.1)
+    thread = threading.Thread(target=call, args=(pool, ["-ver"], waiting), daemon=True)
+    thread.start()
+    thread.join(10)
+    pool.close()
+
+    assert isinstance(dying[0], ExifException)
+    assert waiting == ["-ver"]
+
+
+def test_close_wakes_waiting_caller(exiftool):
+    pool = ExifToolPool(1, exiftool)
+    pool._acquire()
+    results = []
+    thread = threading.Thread(target=call, args=(pool, ["-ver"], results), daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    pool.close()
+    thread.join(10)
+
+    assert len(results) == 1 and isinstance(results[0], ExifException)
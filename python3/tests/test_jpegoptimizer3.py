@@ -0,0 +1,146 @@
+import os
+
+from PIL import Image
+
+import jpegoptimizer3
+from conftest import write_jpeg
+from jpegoptimizer3 import encode_to_budget, optimize_file, optimize_folder
+
+
+def budget_image():
+    """noise, which the shrunk probe of choose_quality underestimates by far"""
+    return Image.effect_noise((1200, 900), 64).convert("RGB")
+
+
+def test_undecodable_image_is_removed(tmp_path, log):
+    good = write_jpeg(str(tmp_path / "a" / "good.jpg"))
+    garbage = str(tmp_path / "a" / "garbage.jpg")
+    with open(garbage, "wb") as f:
+        f.write(b"no image at all")
+    truncated = str(tmp_path / "a" / "truncated.jpg")
+    with open(write_jpeg(truncated), "rb+") as f:
+        f.truncate(os.path.getsize(truncated) // 2)
+
+    totals = optimize_folder(str(tmp_path), False, log)
+
+    assert os.path.exists(good)
+    assert not os.path.exists(garbage)
+    assert not os.path.exists(truncated)
+    assert totals["failed"] == 2
+
+
+def test_unreadable_image_is_kept(tmp_path, log, monkeypatch):
+    image = write_jpeg(str(tmp_path / "a" / "locked.jpg"))
+    with open(image, "rb") as f:
+        content = f.read()
+
+    def locked(*args, **kwargs):
+        raise PermissionError(13, "Permission denied", image)
+    monkeypatch.setattr(jpegoptimizer3.Image, "open", locked)
+
+    totals = optimize_folder(str(tmp_path), False, log)
+
+    assert totals["failed"] == 1
+    with open(image, "rb") as f:
+        assert f.read() == content
+
+
+def test_image_without_exif_is_removed(tmp_path, log):
+    image = write_jpeg(str(tmp_path / "a" / "plain.jpg"), exif=False)
+
+    totals = optimize_folder(str(tmp_path), False, log)
+
+    assert totals["failed"] == 1
+    assert not os.path.exists(image)
+
+
+def test_tagging_failure_optimizes_untagged(tmp_path, log, monkeypatch):
+    # a plain text XMP description, which addmaptags3 cannot parse
+    monkeypatch.setattr(jpegoptimizer3.PILExifReader, "get_XMP_description",
+                        lambda self: "a walk in the park")
+    image = write_jpeg(str(tmp_path / "a" / "image.jpg"))
+    size = os.path.getsize(image)
+
+    totals = optimize_folder(str(tmp_path), False, log, tag=True)
+
+    assert totals["failed"] == 0
+    assert os.path.getsize(image) != size
+
+
+def test_tagging_failure_of_optimized_image_is_kept(tmp_path, log, monkeypatch):
+    image = write_jpeg(str(tmp_path / "a" / "image.jpg"))
+    optimize_folder(str(tmp_path), False, log)
+    monkeypatch.setattr(jpegoptimizer3.PILExifReader, "get_XMP_description",
+                        lambda self: "a walk in the park")
+
+    totals = optimize_folder(str(tmp_path), False, log, tag=True)
+
+    assert totals["failed"] == 0
+    assert totals["skipped"] == 1
+    assert os.path.exists(image)
+
+
+def test_rerun_skips_optimized_images(tmp_path, log):
+    write_jpeg(str(tmp_path / "a" / "image.jpg"))
+    optimize_folder(str(tmp_path), False, log, max_width=32)
+
+    totals = optimize_folder(str(tmp_path), False, log, max_width=32)
+
+    assert totals["skipped"] == 1
+
+
+def test_rerun_with_other_settings_optimizes_again(tmp_path, log):
+    image = write_jpeg(str(tmp_path / "a" / "image.jpg"))
+    optimize_folder(str(tmp_path), False, log)
+
+    totals = optimize_folder(str(tmp_path), False, log, max_width=32)
+    assert totals["skipped"] == 0
+    with Image.open(image) as opened:
+        assert opened.width == 32
+
+    totals = optimize_folder(str(tmp_path), False, log, max_width=32, target_bytes=2000)
+    assert totals["skipped"] == 0
+
+
+def test_rerun_skips_image_named_like_settings(tmp_path, log):
+    write_jpeg(str(tmp_path / "a" / "settings=w32 0.jpg"))
+    optimize_folder(str(tmp_path), False, log)
+
+    assert optimize_folder(str(tmp_path), False, log)["skipped"] == 1
+
+
+def test_target_bytes_fits_file_with_exif(tmp_path, log):
+    image = write_jpeg(str(tmp_path / "a" / "0.jpg"), 1200, 900)
+
+    optimize_file(image, log, target_bytes=400000)
+
+    assert 0.8 * 400000 <= os.path.getsize(image) <= 400000
+    with Image.open(image) as optimized:
+        assert "exif" in optimized.info
+
+
+def test_target_bpp_fits_file_with_exif(tmp_path, log):
+    image = write_jpeg(str(tmp_path / "a" / "0.jpg"), 1200, 900)
+
+    optimize_file(image, log, target_bpp=3.0)
+
+    assert os.path.getsize(image) <= 3.0 * 1200 * 900 / 8
+
+
+def test_budget_fits_or_falls_to_min_quality(log):
+    image = budget_image()
+    exif_data = b"Exif\0\0" + bytes(2000)
+    for target_bytes in (330000, 400000, 600000):
+        data, quality = encode_to_budget(image, target_bytes, exif_data, log)
+        assert len(data) <= target_bytes
+        assert 30 < quality < 90
+
+    data, quality = encode_to_budget(image, 10000, exif_data, log)
+    assert quality == 30
+    assert len(data) > 10000
+
+
+def test_large_budget_caps_at_quality_90(log):
+    data, quality = encode_to_budget(budget_image(), 10 ** 8, b"", log)
+
+    assert quality == 90
@@ -0,0 +1,27 @@
+import threading
+
+from pipeline3 import Pipeline, Stage
+
+
+def run_pipeline(pipeline, file_paths):
+    """runs the pipeline in a thread, returns whether it finished in time"""
+    thread = threading.Thread(target=pipeline.run, args=(file_paths,), daemon=True)
+    thread.start()
+    thread.join(30)
+    return not thread.is_alive()
+
+
+def test_pipeline_finishes_when_on_done_raises(log):
+    done = []
+
+    def on_done(file_path):
+        done.append(file_path)
+        raise RuntimeError("publishing failed")
+
+    file_paths = ["%03d.jpg" % i for i in range(50)]
+    stages = [Stage("first", lambda file_path: True, 2),
+              Stage("second", lambda file_path: file_path[-5] != "7", 2)]
+    pipeline = Pipeline(stages, log, queue_size=2, on_done=on_done)
+
+    assert run_pipeline(pipeline, file_paths)
+    assert sorted(done) == file_paths
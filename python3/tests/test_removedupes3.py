@@ -0,0 +1,75 @@
+import datetime
+
+from benchmark3 import make_track_records
+from removedupes3 import GPSSpatialDuplicateFinder, GPSSpeedErrorFinder
+
+
+def track(frames, jumps=()):
+    """a track at 18 km/h with a GPS speed, the frames in jumps are a kilometer off"""
+    start = datetime.datetime(2019, 5, 17, 9, 0, 0)
+    return [r._replace(lat=r.lat + 0.01 if i in jumps else r.lat, speed=40.0,
+                       gps_time=start + datetime.timedelta(seconds=i))
+            for i, r in enumerate(make_track_records(frames, 1))]
+
+
+def errors(records):
+    finder = GPSSpeedErrorFinder(150, 200)
+    finder.prepare(records)
+    return [r.file_path for r in records if finder.is_error(r)]
+
+
+def test_smooth_track_has_no_errors():
+    assert errors(track(2000)) == []
+
+
+def test_glitch_flags_only_the_glitched_frames():
+    jumps = {i for i in range(10000) if i % 1000 == 500}
+
+    assert errors(track(10000, jumps)) == ["%07d.jpg" % i for i in sorted(jumps)]
+
+
+def test_glitch_of_several_frames():
+    assert errors(track(100, {10, 11, 12, 99})) == ["0000010.jpg", "0000011.jpg",
+                                                   "0000012.jpg", "0000099.jpg"]
+
+
+def test_high_gps_speed_is_an_error():
+    records = track(10)
+    records[3] = records[3]._replace(speed=180.0)
+    records[5] = records[5]._replace(speed=250.0)
+
+    assert errors(records) == ["0000003.jpg", "0000005.jpg"]
+
+
+def duplicates(records):
+    finder = GPSSpatialDuplicateFinder(3, 20)
+    found = []
+    for record in records:
+        is_duplicate = finder.is_duplicate(record)
+        finder.latest_is_duplicate(is_duplicate)
+        if is_duplicate:
+            found.append(record.file_path)
+    return found
+
+
+def test_second_pass_is_duplicate():
+    # 10 m apart, so the meter of GPS noise never brings two frames of a pass within 3 m
+    records = make_track_records(200, 2, spacing=10.0)
+    found = duplicates(records)
+
+    assert all(file_path >= "%07d.jpg" % 100 for file_path in found)
+    assert len(found) >= 80
+
+
+def test_opposite_heading_is_no_duplicate():
+    records = make_track_records(200, 2, spacing=10.0)
+    back = [r._replace(direction=(r.direction + 180) % 360) for r in records[100:]]
+
+    assert duplicates(records[:100] + back) == []
+
+
+def test_record_without_position_is_no_duplicate():
+    records = make_track_records(200, 2, spacing=10.0)
+    unplaced = [r._replace(lat=None, lon=None) for r in records[100:]]
+
+    assert duplicates(records[:100] + unplaced + records[:1]) == ["0000000.jpg"]
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+from conftest import write_jpeg
+from tinyuploader3 import DirectoryUpload
+from uploadindex3 import UploadIndex, image_data_hash
+
+
+class FakeClient:
+    """an UploadClient whose publishing fails if publish_error is set"""
+
+    def __init__(self, publish_error=None):
+        self.publish_error = publish_error
+
+    def create_session(self, subdir, log):
+        session = {'key': "session-1"}
+        with open(subdir + os.sep + "session.json", "w") as f:
+            f.write(json.dumps(session))
+        return session
+
+    def upload_image(self, session, filepath):
+        pass
+
+    def publish_session(self, session, log):
+        if self.publish_error is not None:
+            raise self.publish_error
+
+
+def upload(tmp_path, log, client):
+    file_path = str(tmp_path / "a" / "0.jpg")
+    write_jpeg(file_path)
+    index = UploadIndex(str(tmp_path / "index.sqlite"))
+    directory = DirectoryUpload(client, os.path.dirname(file_path), False, log, index)
+    assert directory.upload(file_path)
+    return directory, index, image_data_hash(file_path)
+
+
+def test_published_uploads_are_indexed(tmp_path, log):
+    directory, index, content_hash = upload(tmp_path, log, FakeClient())
+
+    assert index.lookup(content_hash) is None
+    assert directory.finish() == "published"
+    assert index.lookup(content_hash)[0] == "session-1"
+
+
+def test_unpublished_uploads_are_not_indexed(tmp_path, log):
+    directory, index, content_hash = upload(tmp_path, log, FakeClient(RuntimeError("down")))
+
+    with pytest.raises(RuntimeError):
+        directory.finish()
+    assert index.lookup(content_hash) is None
+
+
+def test_uploads_of_earlier_run_are_indexed_when_resumed_session_is_published(tmp_path, log):
+    directory, index, content_hash = upload(tmp_path, log, FakeClient(RuntimeError("down")))
+    with pytest.raises(RuntimeError):
+        directory.finish()
+
+    resumed = DirectoryUpload(FakeClient(), str(tmp_path / "a"), False, log, index)
+    assert resumed.is_done(str(tmp_path / "a" / "0.jpg"))
+    assert resumed.finish() == "published"
+    assert index.lookup(content_hash)[0] == "session-1"
+    assert index.lookup(content_hash)[2] == "0.jpg"
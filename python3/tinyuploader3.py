@@ -1,25 +1,97 @@
+import io
 import json
 import logging
 import os
 import pprint
+import queue
+import random
 import sys
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 import tqdm
 
+from scanner3 import scan_folder
+from uploadindex3 import UploadIndex, image_data_hash
 
-def upload_image(session, filepath):
+client_id = 'd0FVV29VMDR6SUVrcV94cTdabHBoZzoxZjc2MTE1Mzc1YjMxNzhi'
+# may be pointed at a local stand-in, see uploadserver3.py
+api_url = 'https://a.mapillary.com/v3'
+# seconds to connect and to wait for an answer, a stalled request is retried
+request_timeout = (10, 120)
+# answers worth trying again, everything else fails at once
+retry_status_codes = (429, 500, 502, 503, 504)
+
+
+class MultipartStream:
+    """multipart/form-data body of some form fields followed by one file.
+    The file is read in blocks while the body is sent, instead of requests
+    building the whole body, i.e. a copy of the image, in memory first.
+    The length is known up front, so it goes out with a Content-Length
+    as S3 form uploads require, not chunked."""
+    block_size = 64 * 1024
+
+    def __init__(self, fields, file_field, filename, f, file_content_type="image/jpeg"):
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        head = []
+        for name, value in fields.items():
+            head.append("--" + boundary + "\r\n" +
+                        'Content-Disposition: form-data; name="' + name + '"\r\n\r\n' +
+                        str(value) + "\r\n")
+        head.append("--" + boundary + "\r\n" +
+                    'Content-Disposition: form-data; name="' + file_field + '"; filename="' +
+                    filename.replace('"', "%22") + '"\r\n' +
+                    "Content-Type: " + file_content_type + "\r\n\r\n")
+        head = "".join(head).encode("utf-8")
+        tail = ("\r\n--" + boundary + "--\r\n").encode("utf-8")
+        self._length = len(head) + os.fstat(f.fileno()).st_size + len(tail)
+        self._parts = [io.BytesIO(head), f, io.BytesIO(tail)]
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        blocks = []
+        while size > 0 and self._parts:
+            block = self._parts[0].read(size)
+            if not block:
+                self._parts.pop(0)
+                continue
+            blocks.append(block)
+            size -= len(block)
+        return b"".join(blocks)
+
+    def __iter__(self):
+        while True:
+            block = self.read(self.block_size)
+            if not block:
+                break
+            yield block
+
+
+def upload_image(session, filepath, http=requests, streaming=True):
+    """posts one image into the session, streaming it from disk unless streaming is False"""
     filename = os.path.basename(filepath)
     fields = session['fields'].copy()
     fields['key'] = session['key_prefix'] + filename
     with open(filepath, 'rb') as f:
-        r = requests.post(session['url'], data=fields,
-                          files={'file': (filename, f)})
+        if streaming:
+            body = MultipartStream(fields, 'file', filename, f)
+            r = http.post(session['url'], data=body, headers={'Content-Type': body.content_type},
+                          timeout=request_timeout)
+        else:
+            r = http.post(session['url'], data=fields,
+                          files={'file': (filename, f)}, timeout=request_timeout)
     r.raise_for_status()
 
 
-def create_session(subdir, access_token, client_id, log):
+def create_session(subdir, access_token, client_id, log, http=requests):
     data = {
         'type': 'images/sequence'
     }
@@ -27,8 +99,9 @@ def create_session(subdir, access_token, client_id, log):
         "Authorization": "Bearer " + access_token,
         "Content-Type": "application/json"
     }
-    r = requests.post('https://a.mapillary.com/v3/me/uploads?client_id=' +
-                      client_id, data=json.dumps(data), headers=headers)
+    r = http.post(api_url + '/me/uploads?client_id=' +
+                  client_id, data=json.dumps(data), headers=headers, timeout=request_timeout)
+    r.raise_for_status()
     session = r.json()
     # pprint(session)
     log.info("Session open: " + session['key'])
@@ -38,88 +111,631 @@ def create_session(subdir, access_token, client_id, log):
     return session
 
 
-def publish_session(session, access_token, client_id, log):
+def publish_session(session, access_token, client_id, log, http=requests):
     key = session['key']
     headers = {
         "Authorization": "Bearer " + access_token
     }
-    r = requests.put("https://a.mapillary.com/v3/me/uploads/" +
-                     key + "/closed?client_id=" + client_id, headers=headers)
+    r = http.put(api_url + "/me/uploads/" +
+                 key + "/closed?client_id=" + client_id, headers=headers, timeout=request_timeout)
+    r.raise_for_status()
     log.info("*** Session published: " + session['key'])
     log.info(pprint.pformat(r))
     return
 
 
-def delete_session(access_token, client_id, log):
+def delete_session(access_token, client_id, log, http=requests):
     headers = {
         "Authorization": "Bearer " + access_token
     }
-    r = requests.get(
-        "https://a.mapillary.com/v3/me/uploads?client_id=" + client_id, headers=headers)
+    r = http.get(
+        api_url + "/me/uploads?client_id=" + client_id, headers=headers, timeout=request_timeout)
     sessions = r.json()
     for session in sessions:
         log.info("Delete Session:", session['key'])
-        r = requests.delete("https://a.mapillary.com/v3/uploads/" +
-                            session['key'] + "?client_id=" + client_id, headers=headers)
+        r = http.delete(api_url + "/uploads/" +
+                        session['key'] + "?client_id=" + client_id, headers=headers, timeout=request_timeout)
         r.raise_for_status()
 
 
-def image_files(files):
-    return [f for f in files if f.lower().endswith('.jpg')
-            or f.lower().endswith('.jpeg')]
+class TokenBucket:
+    """Allows rate units per second on average, in bursts of up to capacity.
+    A request larger than capacity waits for a full bucket and is paid back
+    afterwards, so single images larger than a second of bandwidth pass."""
+
+    def __init__(self, rate, capacity=None):
+        self._rate = float(rate)
+        self._capacity = float(capacity or rate)
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens +
+                           (now - self._last) * self._rate)
+        self._last = now
+
+    def acquire(self, amount=1):
+        # waiting while holding the lock lets callers through in order
+        with self._lock:
+            self._refill()
+            needed = min(amount, self._capacity)
+            if self._tokens < needed:
+                time.sleep((needed - self._tokens) / self._rate)
+                self._refill()
+            self._tokens -= amount
+
+
+class UploadScheduler:
+    """Runs API requests under an optional request rate and bandwidth limit
+    (TokenBucket) and retries transient failures, i.e. connection errors,
+    timeouts and retry_status_codes, with jittered exponential backoff."""
+
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60.0,
+                 requests_per_second=None, bytes_per_second=None):
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._request_bucket = TokenBucket(
+            requests_per_second) if requests_per_second else None
+        self._byte_bucket = TokenBucket(
+            bytes_per_second) if bytes_per_second else None
+
+    @staticmethod
+    def is_transient(error):
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code in retry_status_codes
+        return False
+
+    def run(self, log, function, *args, size=0):
+        """calls function(*args), size is the number of bytes it sends"""
+        attempt = 0
+        while True:
+            if self._request_bucket:
+                self._request_bucket.acquire()
+            if self._byte_bucket and size > 0:
+                self._byte_bucket.acquire(size)
+            try:
+                return function(*args)
+            except Exception as error:
+                if attempt >= self._max_retries or not self.is_transient(error):
+                    raise
+                # full jitter, so concurrent uploads do not retry in lockstep
+                delay = random.uniform(0, min(self._max_backoff,
+                                              self._backoff * 2 ** attempt))
+                attempt += 1
+                log.warning("request failed (" + repr(error) + "), retry " + str(attempt) +
+                            " of " + str(self._max_retries) + " in " + "%.1f" % delay + " s")
+                time.sleep(delay)
+
+
+class UploadClient:
+    """Talks to the upload API through one requests.Session, so TCP and TLS
+    connections are kept alive and reused instead of opened per request.
+    pool_size is the number of connections kept per host, it should be at
+    least the number of concurrent uploads, more requests wait for a free one.
+    All requests go through the UploadScheduler for retries and limits."""
+
+    def __init__(self, access_token, pool_size=10, scheduler=None, log=logging.getLogger(__name__)):
+        self.access_token = access_token
+        self._scheduler = scheduler or UploadScheduler()
+        self._log = log
+        self._http = requests.Session()
+        self._adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                                                      pool_block=True)
+        self._http.mount("http://", self._adapter)
+        self._http.mount("https://", self._adapter)
+
+    def upload_image(self, session, filepath):
+        self._scheduler.run(self._log, upload_image, session, filepath, self._http,
+                            size=os.path.getsize(filepath))
+
+    def create_session(self, subdir, log):
+        return self._scheduler.run(log, create_session, subdir, self.access_token,
+                                   client_id, log, self._http)
+
+    def publish_session(self, session, log):
+        self._scheduler.run(log, publish_session, session, self.access_token,
+                            client_id, log, self._http)
+
+    def delete_session(self, log):
+        self._scheduler.run(log, delete_session, self.access_token,
+                            client_id, log, self._http)
+
+    def connection_stats(self):
+        """Returns the number of requests, opened connections and requests on a reused connection"""
+        pools = self._adapter.poolmanager.pools
+        requests_sent = 0
+        connections = 0
+        for key in pools.keys():
+            pool = pools[key]
+            requests_sent += pool.num_requests
+            connections += pool.num_connections
+        return {"requests": requests_sent, "connections": connections,
+                "reused": requests_sent - connections}
+
+    def close(self):
+        self._http.close()
+
+
+class UploadJournal:
+    """Append-only record of a directory's uploads next to session.json, one
+    "session <key>", "done <image data hash or -> <file name>" or
+    "published <key>" per line.
+    Lines are fsynced every batch_size uploads and on session changes, so
+    after a crash at most one batch is uploaded again."""
+    file_name = "session.journal"
+
+    def __init__(self, subdir, batch_size=32):
+        self._path = subdir + os.sep + self.file_name
+        self._batch_size = batch_size
+        self._pending = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self.session_key = None
+        self.published = False
+        # file names uploaded in any session of this directory
+        self.done = set()
+        # image_data_hash by file name of the uploads of the current session
+        self.hashes = {}
+        if os.path.exists(self._path):
+            with open(self._path, "r") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # torn last line of a crash
+                    kind, _, value = line[:-1].partition(" ")
+                    if kind == "session":
+                        self.session_key = value
+                        self.published = False
+                        self.hashes = {}
+                    elif kind == "done":
+                        content_hash, _, file_name = value.partition(" ")
+                        self.done.add(file_name)
+                        if content_hash != "-":
+                            self.hashes[file_name] = content_hash
+                    elif kind == "published" and value == self.session_key:
+                        self.published = True
+
+    def _append(self, line):
+        if self._file is None:
+            self._file = open(self._path, "a")
+        self._file.write(line + "\n")
+
+    def start_session(self, key):
+        with self._lock:
+            self._append("session " + key)
+            self.session_key = key
+            self.published = False
+            self.hashes = {}
+            self._sync()
+
+    def record(self, file_name, content_hash=None):
+        """journals file_name as uploaded, with its image_data_hash if it was uploaded
+           into the current session and the hash is known"""
+        with self._lock:
+            self._append("done " + (content_hash or "-") + " " + file_name)
+            self.done.add(file_name)
+            if content_hash:
+                self.hashes[file_name] = content_hash
+            self._pending += 1
+            if self._pending >= self._batch_size:
+                self._sync()
+
+    def mark_published(self):
+        with self._lock:
+            self._append("published " + self.session_key)
+            self.published = True
+            self._sync()
+
+    def session_hashes(self):
+        """(file name, image_data_hash) of the uploads of the current session, also
+           of those of an earlier run"""
+        with self._lock:
+            return list(self.hashes.items())
+
+    def _sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
 
 
-def upload_folder(folder_path, dry_run, log):
+class DirectoryUpload:
+    """Uploads the images of one directory as one session. An open session
+    from an earlier run is resumed and images already in its UploadJournal
+    are skipped. Images failing even after the scheduler's retries are kept
+    for one more try by retry_failed() at the end of the session.
+    Images found in the uploadindex3.UploadIndex index were uploaded
+    under another name before and are skipped as well. The images of a
+    session, also those journaled by an earlier run, are added to the
+    index once it is published.
+    Safe to use from several threads."""
+
+    def __init__(self, client, path, dry_run, log, index=None):
+        self._client = client
+        self._path = path
+        self._dry_run = dry_run
+        self._log = log
+        self._session = None
+        self._failed = []
+        self.uploaded = 0
+        self.known = 0
+        self._index = index
+        self._lock = threading.Lock()
+        self.journal = UploadJournal(path)
+
+    def is_done(self, file_path):
+        return os.path.basename(file_path) in self.journal.done
+
+    def checks_index(self):
+        """whether upload() looks up the image_data_hash of the images"""
+        return self._index is not None and not self._dry_run
+
+    def _load_session(self):
+        # resume the session of the journal if it is still open
+        session_path = self._path + os.sep + "session.json"
+        if self.journal.session_key is None or self.journal.published or not os.path.exists(session_path):
+            return None
+        with open(session_path, "r") as f:
+            session = json.load(f)
+        if session.get('key') != self.journal.session_key:
+            return None
+        self._log.info("Session resumed: " + session['key'])
+        return session
+
+    def session(self):
+        with self._lock:
+            if self._session is None and not self._dry_run:
+                self._session = self._load_session()
+                if self._session is None:
+                    self._session = self._client.create_session(
+                        self._path, self._log)
+                    self.journal.start_session(self._session['key'])
+            return self._session
+
+    def upload(self, file_path, content_hash=None):
+        """uploads file_path unless it is already journaled or indexed, returns if it was uploaded
+           content_hash is its image_data_hash if already known
+        """
+        if self.is_done(file_path):
+            return False
+        if self._dry_run:
+            time.sleep(0.01)
+            return True
+        if self._index is not None:
+            if content_hash is None:
+                content_hash = image_data_hash(file_path)
+            known = self._index.lookup(content_hash)
+            if known is not None:
+                self._log.info("already uploaded as " + known[2] + " in session " +
+                               known[0] + ": " + file_path)
+                with self._lock:
+                    self.known += 1
+                self.journal.record(os.path.basename(file_path))
+                return False
+        session = self.session()
+        try:
+            self._client.upload_image(session, file_path)
+        except Exception:
+            with self._lock:
+                if file_path not in self._failed:
+                    self._failed.append(file_path)
+            raise
+        with self._lock:
+            if file_path in self._failed:
+                self._failed.remove(file_path)
+            self.uploaded += 1
+        self.journal.record(os.path.basename(file_path), content_hash)
+        return True
+
+    def session_key(self):
+        with self._lock:
+            return self._session['key'] if self._session else None
+
+    def failed_count(self):
+        with self._lock:
+            return len(self._failed)
+
+    def retry_failed(self):
+        """tries the failed images once more, returns the number still failing"""
+        with self._lock:
+            failed = list(self._failed)
+        if failed:
+            self._log.info("   *** Retrying " + str(len(failed)) +
+                           " failed uploads: " + self._path)
+        for file_path in failed:
+            try:
+                self.upload(file_path)
+            except Exception as error:
+                self._log.error("upload failed: " + file_path + ": " + repr(error))
+        with self._lock:
+            return len(self._failed)
+
+    def finish(self):
+        """publishes the session once, unless an upload failed, so a rerun can resume it
+           returns what became of the session: published, left open, nothing to publish or dry run
+        """
+        try:
+            if self._dry_run:
+                return "dry run"
+            with self._lock:
+                if self._session is None:
+                    # everything was journaled, but a crash may have hit before publishing
+                    self._session = self._load_session()
+                session = self._session
+                failed = len(self._failed)
+            if session is None:
+                return "nothing to publish"
+            if failed > 0:
+                self._log.warning("   *** " + str(failed) + " uploads failed, not publishing " +
+                                  session['key'] + ", run again to resume it: " + self._path)
+                return "left open"
+            self.journal.sync()
+            self._client.publish_session(session, self._log)
+            self.journal.mark_published()
+            # only published images may stand in for an upload of another directory
+            if self._index is not None:
+                for file_name, content_hash in self.journal.session_hashes():
+                    self._index.add(content_hash, session['key'], file_name)
+            return "published"
+        finally:
+            self.journal.close()
+
+
+class SessionManager:
+    """Runs the session calls of upload_folder beside the image uploads:
+    the sessions of the next prefetch directories are opened while the
+    current ones upload, finished ones are published in the background,
+    and at most max_open sessions are open (opened, not yet published) at
+    once. The state of every directory is kept for write_summary()."""
+
+    def __init__(self, client, image_dirs, dry_run, log, prefetch=2, max_open=4, index=None):
+        self._client = client
+        self._index = index
+        self._image_dirs = image_dirs
+        self._dry_run = dry_run
+        self._log = log
+        self._prefetch = prefetch
+        self._open_slots = threading.Semaphore(max_open)
+        self._lock = threading.Lock()
+        self._uploads = {}
+        self._opened = {}
+        self._holding = set()
+        self._next_open = 0
+        # one opener thread opens strictly in directory order, so a directory
+        # never waits for a slot held by a later, prefetched one
+        self._opener = ThreadPoolExecutor(1)
+        self._publisher = ThreadPoolExecutor(2)
+        self._summary = [{"directory": path, "images": len(entries), "state": "waiting"}
+                         for path, entries in image_dirs]
+
+    def _set_state(self, index, state):
+        with self._lock:
+            entry = self._summary[index]
+            entry["state"] = state
+            entry[state.replace(" ", "_")] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            directory = self._uploads.get(index)
+            if directory is not None:
+                entry["session"] = directory.session_key()
+                entry["uploaded"] = directory.uploaded
+                entry["failed"] = directory.failed_count()
+                entry["known"] = directory.known
+
+    def _open(self, index):
+        path, entries = self._image_dirs[index]
+        directory = DirectoryUpload(self._client, path, self._dry_run, self._log, self._index)
+        with self._lock:
+            self._uploads[index] = directory
+        if all(directory.is_done(entry.path) for entry in entries):
+            return directory
+        self._open_slots.acquire()
+        with self._lock:
+            self._holding.add(index)
+        try:
+            directory.session()
+            self._set_state(index, "open")
+        except Exception as error:
+            # uploading will try to open it again and report the failures
+            self._log.error("opening session failed: " + path + ": " + repr(error))
+        return directory
+
+    def start(self, index):
+        """returns the DirectoryUpload of the index-th directory, with its session open if needed"""
+        with self._lock:
+            while self._next_open < min(len(self._image_dirs), index + 1 + self._prefetch):
+                self._opened[self._next_open] = self._opener.submit(
+                    self._open, self._next_open)
+                self._next_open += 1
+            future = self._opened.pop(index)
+        directory = future.result()
+        self._set_state(index, "uploading")
+        return directory
+
+    def _publish(self, index, directory):
+        try:
+            directory.retry_failed()
+            self._set_state(index, directory.finish())
+        except Exception as error:
+            self._log.error("publishing session failed: " +
+                            self._image_dirs[index][0] + ": " + repr(error))
+            self._set_state(index, "publish failed")
+        finally:
+            with self._lock:
+                holding = index in self._holding
+                self._holding.discard(index)
+            if holding:
+                self._open_slots.release()
+
+    def finish(self, index, directory):
+        """publishes the directory in the background"""
+        self._set_state(index, "publishing")
+        self._publisher.submit(self._publish, index, directory)
+
+    def close(self):
+        """waits for the pending session calls"""
+        self._opener.shutdown(wait=True)
+        self._publisher.shutdown(wait=True)
+
+    def summary(self):
+        with self._lock:
+            return [dict(entry) for entry in self._summary]
+
+    def write_summary(self, file_path):
+        with open(file_path, "w") as f:
+            f.write(json.dumps(self.summary(), sort_keys=True, indent=4))
+
+
+def read_access_token(log):
+    log.info("   *** Read access token")
+    with open(os.path.dirname(os.path.realpath(sys.argv[0])) + os.sep + "accesstoken3.conf", "r") as image_name:
+        return image_name.read()
+
+
+def upload_entries(directory, entries, log, concurrency=1, on_uploaded=None):
+    """uploads the entries through a DirectoryUpload without finishing it"""
+    skipped = len([entry for entry in entries if directory.is_done(entry.path)])
+    if skipped > 0:
+        log.info("   *** Skipping " + str(skipped) +
+                 " images uploaded before: " + os.path.dirname(entries[0].path))
+    pending = [entry for entry in entries if not directory.is_done(entry.path)]
+    hasher = ThreadPoolExecutor(1)
+    # the images are hashed in upload order by their own thread, ahead of the
+    # uploads, so an upload rarely waits for its hash
+    hashes = {}
+    if directory.checks_index():
+        hashes = {entry.path: hasher.submit(image_data_hash, entry.path) for entry in pending}
+
+    def upload(file_path):
+        content_hash = hashes[file_path].result() if file_path in hashes else None
+        return directory.upload(file_path, content_hash)
+
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = {executor.submit(upload, entry.path): entry.path
+                       for entry in entries}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as error:
+                    log.error("upload failed: " + futures[future] + ": " + repr(error))
+                if on_uploaded:
+                    on_uploaded()
+        directory.retry_failed()
+    except BaseException:
+        directory.journal.close()
+        raise
+    finally:
+        # shutdown(cancel_futures=True) needs Python 3.9
+        for future in hashes.values():
+            future.cancel()
+        hasher.shutdown(wait=True)
+
+
+def upload_folder(folder_path, dry_run, log, manifest=None, concurrency=1, parallel_sessions=1,
+                  access_token=None, scheduler=None, prefetch_sessions=2, max_open_sessions=None,
+                  use_index=True, index_path=None):
+    """uploads every directory of the scanner3.Manifest of folder_path, scanned if not given,
+       as one sequence
+       concurrency is the number of images in flight per session, parallel_sessions
+       the number of directories uploaded at once, scheduler an UploadScheduler
+       for the retry and rate limit settings
+       the sessions of the next prefetch_sessions directories are opened ahead, at most
+       max_open_sessions (default parallel_sessions + prefetch_sessions) are open at once
+       the state of every session is written to upload_summary.json in folder_path
+       with use_index, images found in the uploadindex3.UploadIndex at index_path,
+       next to the scripts if not given, are not uploaded again under another name
+    """
     if dry_run:
         log.warning(
             "*** DRY RUN, NOT ACTUALLY UPLOADING ANY IMAGERY, THE FOLLOWING IS SAMPLE OUTPUT")
 
-    client_id = 'd0FVV29VMDR6SUVrcV94cTdabHBoZzoxZjc2MTE1Mzc1YjMxNzhi'
-    log.info("   *** Read access token")
-    with open(os.path.dirname(os.path.realpath(sys.argv[0])) + os.sep + "accesstoken3.conf", "r") as image_name:
-        access_token = image_name.read()
+    if access_token is None:
+        access_token = read_access_token(log)
 
     if not(os.path.isdir(folder_path)):
         log.warning("No valid directory given for upload as parameter.")
         exit(1)
 
-    # compute totals for progress bar
-    total_images = 0
-    total_image_dirs = 0
-    for path, _, files in os.walk(folder_path):
-        new_images = len(image_files(files))
-        total_images += new_images
-        if new_images > 0:
-            total_image_dirs += 1
-
-    # initialize progress bars
-    total_pbar = tqdm.tqdm(total=total_images, dynamic_ncols=True)
+    if manifest is None:
+        manifest = scan_folder(folder_path)
+    total_images = manifest.total_images
+    total_image_dirs = manifest.total_image_dirs
+
+    # one connection per image in flight, plus some for the session calls
+    client = UploadClient(access_token, pool_size=parallel_sessions * concurrency + 3,
+                          scheduler=scheduler, log=log)
+    image_dirs = manifest.image_dirs()
+    if max_open_sessions is None:
+        max_open_sessions = parallel_sessions + prefetch_sessions
+    index = UploadIndex(index_path) if use_index else None
+    sessions = SessionManager(client, image_dirs, dry_run, log, prefetch_sessions,
+                              max(max_open_sessions, 1), index)
+
+    # initialize progress bars, one per session below the totals
+    total_pbar = tqdm.tqdm(total=total_images, dynamic_ncols=True, position=0)
     if total_image_dirs > 1:
-        dirs_pbar = tqdm.tqdm(total=total_image_dirs, dynamic_ncols=True)
+        dirs_pbar = tqdm.tqdm(total=total_image_dirs,
+                              dynamic_ncols=True, position=1)
     else:
         dirs_pbar = None
+    positions = queue.Queue()
+    for position in range(parallel_sessions):
+        positions.put(position + 2)
+
+    def upload_session(index, path, entries):
+        log.info("   *** Uploading directory: " + path)
+        directory = sessions.start(index)
+        position = positions.get()
+        session_pbar = tqdm.tqdm(total=len(entries), desc=os.path.basename(path),
+                                 dynamic_ncols=True, position=position, leave=False)
+
+        def on_uploaded():
+            session_pbar.update()
+            total_pbar.update()
+        try:
+            upload_entries(directory, entries, log, concurrency, on_uploaded)
+        finally:
+            session_pbar.close()
+            positions.put(position)
+        sessions.finish(index, directory)
+        if dirs_pbar:
+            dirs_pbar.update()
 
-    for path, _, files in sorted(os.walk(folder_path)):
-        if len(files) > 0:
-            log.info("   *** Uploading directory: " + path)
-            if not dry_run:
-                session = create_session(path, access_token, client_id, log)
-            for image_name in image_files(files):
-                absolute_filepath = path + os.sep + image_name
-                if not dry_run:
-                    upload_image(session, absolute_filepath)
-                else:
-                    time.sleep(1/total_images)
-                total_pbar.update()
-            if not dry_run:
-                publish_session(session, access_token, client_id, log)
-            else:
-                time.sleep(1)
-            if dirs_pbar:
-                dirs_pbar.update()
-    total_pbar.close()
-    if dirs_pbar:
-        dirs_pbar.close()
+    try:
+        with ThreadPoolExecutor(parallel_sessions) as executor:
+            futures = [executor.submit(upload_session, index, path, entries)
+                       for index, (path, entries) in enumerate(image_dirs)]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        sessions.close()
+        total_pbar.close()
+        if dirs_pbar:
+            dirs_pbar.close()
+        if not dry_run:
+            sessions.write_summary(folder_path + os.sep + "upload_summary.json")
+        states = {}
+        for entry in sessions.summary():
+            states[entry["state"]] = states.get(entry["state"], 0) + 1
+        log.info("   *** Sessions: " + str(states))
+        log.info("   *** Connections: " + str(client.connection_stats()))
+        client.close()
+        if index is not None:
+            index.close()
 
 
 #
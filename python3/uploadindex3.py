@@ -0,0 +1,99 @@
+#
+#   file: uploadindex3.py
+#
+#   purpose: remember every uploaded image by a hash of its image data in a
+#            local SQLite file, so an image is not uploaded again after
+#            exifsort3, roadsplit3 or sequencesplit3.move_groups renamed or
+#            moved it. Only the compressed image data is hashed, the APPn and
+#            comment segments are left out, so retagging an image does not
+#            make it look new.
+#
+
+import hashlib
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+block_size = 1024 * 1024
+
+
+def default_index_path():
+    """next to the scripts, like accesstoken3.conf"""
+    return os.path.dirname(os.path.realpath(sys.argv[0])) + os.sep + "uploadindex3.sqlite"
+
+
+def image_data_hash(filepath):
+    """Returns the sha256 hex digest of a JPEG without its APPn (EXIF, XMP, ...)
+    and COM segments. Files that do not parse as JPEG are hashed whole."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        head = f.read(2)
+        digest.update(head)
+        if head == b"\xff\xd8":
+            while True:
+                marker = f.read(4)
+                if len(marker) < 4 or marker[0] != 0xFF:
+                    # broken marker, hash the rest as it is
+                    digest.update(marker)
+                    break
+                if marker[1] == 0xDA:
+                    # start of scan, the compressed data up to the end is hashed
+                    digest.update(marker)
+                    break
+                length = struct.unpack(">H", marker[2:4])[0]
+                if 0xE0 <= marker[1] <= 0xEF or marker[1] == 0xFE:
+                    f.seek(length - 2, os.SEEK_CUR)
+                else:
+                    digest.update(marker)
+                    digest.update(f.read(length - 2))
+        # hashlib drops the GIL for large blocks, so this overlaps with uploads in other threads
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadIndex:
+    """Image data hash -> session key, upload time and file name of every
+    uploaded image. Safe to use from several threads, inserts are committed
+    every batch_size images and on close()."""
+
+    def __init__(self, path=None, batch_size=32):
+        self.path = path or default_index_path()
+        self._batch_size = batch_size
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                         "hash TEXT PRIMARY KEY, session_key TEXT, uploaded REAL, file_name TEXT)")
+        self._db.commit()
+
+    def lookup(self, content_hash):
+        """returns (session_key, uploaded, file_name) of an earlier upload or None"""
+        with self._lock:
+            return self._db.execute("SELECT session_key, uploaded, file_name FROM uploads WHERE hash = ?",
+                                    (content_hash,)).fetchone()
+
+    def add(self, content_hash, session_key, file_name):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+                             (content_hash, session_key, time.time(), file_name))
+            self._pending += 1
+            if self._pending >= self._batch_size:
+                self._db.commit()
+                self._pending = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
@@ -0,0 +1,167 @@
+#
+#   file: uploadserver3.py
+#
+#   purpose: local stand-in for the Mapillary upload API, so the uploader
+#            can be tried and measured without the real service. It answers
+#            the session calls of tinyuploader3 and accepts the multipart
+#            image posts after an optional latency and bandwidth limit,
+#            failing a given share of them with 503 to exercise retries.
+#
+#   usage:   python3 uploadserver3.py --port 8080 --latency 0.1
+#            then set tinyuploader3.api_url = "http://127.0.0.1:8080/v3"
+#
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    # keep-alive, so connection reuse by the client can be observed
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        """reads the request body, plain or chunked, and returns its size"""
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                chunk_size = int(self.rfile.readline().split(b";")[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    break
+                size += self._read_limited(chunk_size)
+                self.rfile.readline()
+        else:
+            size = self._read_limited(
+                int(self.headers.get("Content-Length", 0)))
+        return size
+
+    def _read_limited(self, length):
+        # the data is dropped right away, it must not count towards the client's memory
+        read = 0
+        while read < length:
+            block = self.rfile.read(min(length - read, 64 * 1024))
+            if not block:
+                break
+            read += len(block)
+            if self.server.bandwidth:
+                time.sleep(len(block) / self.server.bandwidth)
+        return read
+
+    def setup(self):
+        # one handler per connection, it serves all requests sent over it
+        super().setup()
+        self.server.count("connections")
+
+    def do_POST(self):
+        if self.path.startswith("/v3/me/uploads"):
+            self._read_body()
+            time.sleep(self.server.session_latency)
+            key = str(uuid.uuid4())
+            self.server.count("sessions")
+            self._send(200, {
+                "key": key,
+                "key_prefix": key + "/",
+                "url": "http://%s:%d/s3" % self.server.server_address[:2],
+                "fields": {"policy": "stand-in", "signature": key},
+            })
+        elif self.path.startswith("/s3"):
+            size = self._read_body()
+            time.sleep(self.server.latency)
+            if random.random() < self.server.failure_rate:
+                self.server.count("failed")
+                self._send(503)
+                return
+            self.server.count("images")
+            self.server.count("bytes", size)
+            self._send(204)
+        else:
+            self._send(404)
+
+    def do_PUT(self):
+        self._read_body()
+        if self.path.startswith("/v3/me/uploads/") and "/closed" in self.path:
+            time.sleep(self.server.session_latency)
+            self.server.count("published")
+            self._send(200, {})
+        else:
+            self._send(404)
+
+    def do_GET(self):
+        if self.path.startswith("/v3/me/uploads"):
+            self._send(200, [])
+        else:
+            self._send(404)
+
+    def do_DELETE(self):
+        self._send(204)
+
+
+class UploadServer(ThreadingHTTPServer):
+    """Stand-in server, latency in seconds per image, bandwidth in bytes per second per request,
+    failure_rate the share of image posts answered with 503, session_latency
+    the seconds to open or publish a session"""
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None, failure_rate=0.0, verbose=False,
+                 session_latency=0.0):
+        super().__init__(("127.0.0.1", port), UploadHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.session_latency = session_latency
+        self.verbose = verbose
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return "http://%s:%d/v3" % self.server_address[:2]
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Mapillary upload API.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='seconds before an image post is answered')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='bytes per second per request, unlimited if not given')
+    parser.add_argument('--failure_rate', type=float, default=0.0,
+                        help='share of image posts answered with 503')
+    parser.add_argument('--session_latency', type=float, default=0.0,
+                        help='seconds before a session is opened or published')
+    args = parser.parse_args()
+    server = UploadServer(args.port, args.latency, args.bandwidth,
+                          args.failure_rate, verbose=True,
+                          session_latency=args.session_latency)
+    print("stand-in API at " + server.api_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.counters)
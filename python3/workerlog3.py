@@ -0,0 +1,37 @@
+#
+#   file: workerlog3.py
+#
+#   purpose: logging of the process pool workers of addmaptags3, jpegoptimizer3
+#            and blurfilter3. A worker keeps its log records and returns them
+#            with its results, the parent replays them into its own log, so
+#            the output is not interleaved between processes.
+#
+
+import logging
+
+
+class RecordingLoggingHandler(logging.Handler):
+    """keeps the log records of a pool worker, so the parent can replay them"""
+
+    def __init__(self, records, level=logging.NOTSET):
+        super().__init__(level)
+        self._records = records
+
+    def emit(self, record):
+        self._records.append((record.levelno, record.getMessage()))
+
+
+def worker_log(name, log_level):
+    """returns the logger of a pool worker and the list of (level, message) its records go to"""
+    records = []
+    log = logging.getLogger(name + ".worker")
+    log.setLevel(log_level)
+    log.propagate = False
+    log.handlers = [RecordingLoggingHandler(records)]
+    return log, records
+
+
+def replay(log, records):
+    """logs the records of a worker_log in the parent"""
+    for level, message in records:
+        log.log(level, message)